@@ -0,0 +1,46 @@
+""" Cold versus warm loading of the compiled models
+
+Usage: python benchmarks/bench_model_load.py [repeat]
+
+Each measurement runs in a fresh python process with its own artifact cache
+(GDR3APCAL_CACHE). The cold load imports and compiles the model source and
+writes the artifact, the warm loads read the cached artifact.
+"""
+import os
+import sys
+import json
+import tempfile
+import subprocess
+
+
+SNIPPET = """
+import time, json
+start = time.perf_counter()
+import gdr3apcal
+imported = time.perf_counter()
+gdr3apcal.GaiaDR3_GSPPhot_cal()['mh']
+loaded = time.perf_counter()
+print(json.dumps({'import': imported - start, 'load': loaded - imported}))
+"""
+
+
+def measure(cachedir: str) -> dict:
+    """ import and load times in a new process """
+    env = dict(os.environ, GDR3APCAL_CACHE=cachedir)
+    output = subprocess.run([sys.executable, '-c', SNIPPET], env=env, check=True,
+                            capture_output=True, text=True).stdout
+    return json.loads(output.strip().split('\n')[-1])
+
+
+def main(repeat: int = 5):
+    print(f"{'':>6s} {'import [ms]':>12s} {'model load [ms]':>16s}")
+    for _ in range(repeat):
+        with tempfile.TemporaryDirectory() as cachedir:
+            cold = measure(cachedir)
+            warm = measure(cachedir)
+        print(f"{'cold':>6s} {1e3 * cold['import']:12.1f} {1e3 * cold['load']:16.1f}")
+        print(f"{'warm':>6s} {1e3 * warm['import']:12.1f} {1e3 * warm['load']:16.1f}")
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:2]])
@@ -0,0 +1,53 @@
+""" Scaling of the chunked SklearnModel prediction
+
+Usage: python benchmarks/bench_sklearn_chunking.py [n_rows]
+
+Times a RandomForestRegressor calibration (an estimator releasing the GIL in
+predict) for increasing numbers of workers with the thread and process
+backends. The speedups are only meaningful on a machine with several cpus.
+"""
+import os
+import sys
+import time
+import numpy
+import pandas
+from sklearn.ensemble import RandomForestRegressor
+from gdr3apcal.calibration_models import SklearnModel
+
+
+def main(n_rows: int = 1_000_000, chunk_size: int = 50_000, repeat: int = 3):
+    rng = numpy.random.default_rng(0)
+    features = ['f{0:d}'.format(k) for k in range(8)]
+    train = rng.normal(size=(20_000, len(features)))
+    estimator = RandomForestRegressor(n_estimators=50, max_depth=12, n_jobs=1, random_state=0)
+    estimator.fit(train, train[:, 0] ** 2 - train[:, 1])
+
+    df = pandas.DataFrame(rng.normal(size=(n_rows, len(features))), columns=features)
+    df['label'] = 0.
+
+    print(f"{n_rows:d} rows, chunks of {chunk_size:d} rows, {os.cpu_count():d} cpus")
+    if os.cpu_count() == 1:
+        print("Single cpu: the timings only show the overhead of the pools, not their scaling.")
+    # 'first' includes starting the pool (and sending the estimator to the
+    # processes), 'warm' reuses the pool kept by the model
+    print(f"{'backend':>8s} {'n_jobs':>6s} {'first [s]':>10s} {'warm [s]':>9s} {'speedup':>8s}")
+    reference = None
+    for backend in ('thread', 'process'):
+        for n_jobs in sorted({1, 2, 4, 8, os.cpu_count()}):
+            model = SklearnModel('bench', estimator, features, 'label',
+                                 n_jobs=n_jobs, chunk_size=chunk_size, backend=backend)
+            start = time.perf_counter()
+            model(df)
+            first = time.perf_counter() - start
+            timings = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                model(df)
+                timings.append(time.perf_counter() - start)
+            model.shutdown()
+            best = min(timings)
+            reference = best if reference is None else reference
+            print(f"{backend:>8s} {n_jobs:6d} {first:10.3f} {best:9.3f} {reference / best:8.2f}")
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:2]])
@@ -0,0 +1,419 @@
+""" Streaming aggregation of calibrated values onto sky maps or feature grids
+
+Maps of the calibrated [M/H] (e.g. per HEALPix pixel or in the Teff-logg
+plane) usually need the full calibrated column before binning it. Here the
+data are calibrated chunk by chunk, and each chunk is immediately reduced to
+per-bin statistics: counts, means and variances (combined with the parallel
+algorithm of Chan et al.) and a fixed fine histogram of the values per bin,
+from which quantiles are interpolated. The memory only depends on the number
+of bins and of the filled histogram cells, and partial aggregates (e.g. one
+per worker process) combine exactly with :meth:`BinnedStatistics.merge`.
+
+.. code-block:: python
+
+    from gdr3apcal.aggregation import HealpixBinning, aggregate_calibration
+    stats = aggregate_calibration(pandas.read_csv('gspphot.csv', chunksize=1_000_000),
+                                  HealpixBinning(level=5))
+    skymap = stats.to_frame()
+"""
+import os
+import queue
+import multiprocessing
+from typing import Iterable, Sequence, Tuple, Union
+import numpy
+import pandas
+# local code
+from .partitions import get_collection, read_partition, iter_chunks, resolve_b_unit, check_b_unit
+from .runner import healpix_from_source_id
+
+
+__all__ = ['HealpixBinning', 'GridBinning', 'BinnedStatistics', 'aggregate_calibration']
+
+
+class HealpixBinning:
+    """ Bins of the HEALPix nested index encoded in the Gaia source_id
+
+    Parameters
+    ----------
+    level: int
+        HEALPix level (0-12), i.e. 12 * 4^level pixels
+    source_id: str
+        column of the Gaia source_id
+    """
+
+    def __init__(self, level: int = 5, source_id: str = 'source_id'):
+        """ Constructor """
+        healpix_from_source_id(0, level)   # validates the level
+        self.level = level
+        self.source_id = source_id
+        self.n_bins = 12 * 4 ** level
+
+    def __call__(self, df: pandas.DataFrame) -> numpy.array:
+        """ Bin index of each row """
+        if self.source_id not in df.columns:
+            raise KeyError(f"Missing {self.source_id:s} from input data to compute the HEALPix index.")
+        return healpix_from_source_id(df[self.source_id].values, self.level)
+
+    def coordinates(self, bins: numpy.array) -> dict:
+        """ Columns describing the given bins """
+        return {'healpix': numpy.asarray(bins, dtype=numpy.int64)}
+
+    def __repr__(self) -> str:
+        """ How it shows on the command line """
+        return "HealpixBinning(level={0:d})".format(self.level)
+
+
+class GridBinning:
+    """ Bins of a regular or irregular grid of input features
+
+    Parameters
+    ----------
+    edges: dict
+        {feature: bin edges}, e.g. {'teff_gspphot': numpy.arange(3500, 9001, 100)}.
+        Rows outside the grid (or with NaN features) are ignored.
+    """
+
+    def __init__(self, edges: dict):
+        """ Constructor """
+        self.edges = {name: numpy.asarray(values, dtype=numpy.float64) for name, values in edges.items()}
+        for name, values in self.edges.items():
+            if len(values) < 2 or (numpy.diff(values) <= 0).any():
+                raise ValueError(f"Bin edges of {name:s} must be increasing with at least 2 values.")
+        self.shape = tuple(len(values) - 1 for values in self.edges.values())
+        self.n_bins = int(numpy.prod(self.shape))
+
+    def __call__(self, df: pandas.DataFrame) -> numpy.array:
+        """ Bin index of each row (-1 outside the grid) """
+        missing = [name for name in self.edges if name not in df.columns]
+        if missing:
+            raise KeyError("Missing features from input data: {0:s}".format(','.join(missing)))
+        bins = numpy.zeros(len(df), dtype=numpy.int64)
+        inside = numpy.ones(len(df), dtype=bool)
+        for name, edges in self.edges.items():
+            index = numpy.searchsorted(edges, df[name].values, side='right') - 1
+            # the last edge closes the last bin
+            index[df[name].values == edges[-1]] = len(edges) - 2
+            inside &= (index >= 0) & (index < len(edges) - 1)
+            bins = bins * (len(edges) - 1) + index
+        bins[~inside] = -1
+        return bins
+
+    def coordinates(self, bins: numpy.array) -> dict:
+        """ Columns describing the given bins (bin centers of each feature) """
+        indices = numpy.unravel_index(numpy.asarray(bins, dtype=numpy.int64), self.shape)
+        return {name: 0.5 * (edges[index] + edges[index + 1])
+                for (name, edges), index in zip(self.edges.items(), indices)}
+
+    def __repr__(self) -> str:
+        """ How it shows on the command line """
+        return "GridBinning({0})".format(', '.join(f'{k}: {n}' for k, n in zip(self.edges, self.shape)))
+
+
+class BinnedStatistics:
+    """ Mergeable per-bin counts, means, variances and quantile sketches
+
+    Parameters
+    ----------
+    n_bins: int
+        number of bins (e.g. `binning.n_bins`)
+    value_range: Tuple[float, float]
+        range of the quantile sketches; values outside are counted in the
+        first or last histogram bin
+    n_sketch_bins: int
+        number of histogram bins of the quantile sketches per bin
+        (0 disables the sketches). The quantiles are accurate to about
+        (vmax - vmin) / n_sketch_bins.
+
+    The sketches are stored sparsely, as the counts of the filled histogram
+    cells only: fine maps (e.g. HEALPix level 7 and beyond) do not need the
+    memory of n_bins x n_sketch_bins counts.
+    """
+
+    def __init__(self, n_bins: int, value_range: Tuple[float, float] = (-5., 2.),
+                 n_sketch_bins: int = 350):
+        """ Constructor """
+        self.n_bins = n_bins
+        self.value_range = (float(value_range[0]), float(value_range[1]))
+        self.n_sketch_bins = n_sketch_bins
+        self.count = numpy.zeros(n_bins, dtype=numpy.int64)
+        self.mean = numpy.zeros(n_bins, dtype=numpy.float64)
+        self.m2 = numpy.zeros(n_bins, dtype=numpy.float64)
+        # sparse sketches: sorted cell keys (bin * n_sketch_bins + cell) and counts,
+        # plus the pending (unsorted) cells of the latest updates
+        self._cells = numpy.zeros(0, dtype=numpy.int64)
+        self._cell_counts = numpy.zeros(0, dtype=numpy.int64)
+        self._pending = []
+        self._n_pending = 0
+
+    def _combine(self, count: numpy.array, mean: numpy.array, m2: numpy.array):
+        """ Combine the moments of other rows (Chan et al. parallel update) """
+        total = self.count + count
+        delta = mean - self.mean
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            weight = numpy.where(total > 0, count / total, 0.)
+        self.mean += delta * weight
+        self.m2 += m2 + delta * delta * self.count * weight
+        self.count = total
+
+    def update(self, bins: numpy.array, values: numpy.array) -> 'BinnedStatistics':
+        """ Add values to their bins (NaN values and negative bins are ignored) """
+        values = numpy.asarray(values, dtype=numpy.float64)
+        keep = (bins >= 0) & numpy.isfinite(values)
+        bins, values = numpy.asarray(bins)[keep], values[keep]
+        if bins.size and bins.max() >= self.n_bins:
+            raise ValueError(f"Bin index {bins.max()} beyond the {self.n_bins:d} bins.")
+
+        count = numpy.bincount(bins, minlength=self.n_bins)
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            mean = numpy.where(count > 0, numpy.bincount(bins, values, self.n_bins) / count, 0.)
+        residuals = values - mean[bins]
+        m2 = numpy.bincount(bins, residuals * residuals, self.n_bins)
+        self._combine(count, mean, m2)
+
+        if self.n_sketch_bins:
+            vmin, vmax = self.value_range
+            cells = ((values - vmin) * (self.n_sketch_bins / (vmax - vmin))).astype(numpy.int64)
+            numpy.clip(cells, 0, self.n_sketch_bins - 1, out=cells)
+            cells += bins * self.n_sketch_bins
+            self._add_cells(cells, numpy.ones(len(cells), dtype=numpy.int64))
+        return self
+
+    def _add_cells(self, cells: numpy.array, counts: numpy.array):
+        """ Add counts to sketch cells; the cells are combined once enough are pending """
+        if not len(cells):
+            return
+        self._pending.append((cells, counts))
+        self._n_pending += len(cells)
+        # amortized: the sorted cells are only rebuilt when the pending ones outnumber them
+        if self._n_pending > max(len(self._cells), 1_000_000):
+            self._compact()
+
+    def _compact(self):
+        """ Combine the pending cells with the sorted ones """
+        if not self._pending:
+            return
+        cells = numpy.concatenate([self._cells] + [c for c, _ in self._pending])
+        counts = numpy.concatenate([self._cell_counts] + [n for _, n in self._pending])
+        self._cells, inverse = numpy.unique(cells, return_inverse=True)
+        self._cell_counts = numpy.bincount(inverse.reshape(-1), counts, len(self._cells)).astype(numpy.int64)
+        self._pending = []
+        self._n_pending = 0
+
+    def sketch_cells(self) -> Tuple[numpy.array, numpy.array]:
+        """ Filled cells of the sketches: (sorted keys bin * n_sketch_bins + cell, counts) """
+        self._compact()
+        return self._cells, self._cell_counts
+
+    @property
+    def sketch(self) -> numpy.array:
+        """ Dense sketches (n_bins, n_sketch_bins); only for small numbers of bins """
+        cells, counts = self.sketch_cells()
+        dense = numpy.zeros(self.n_bins * self.n_sketch_bins, dtype=numpy.int64)
+        dense[cells] = counts
+        return dense.reshape(self.n_bins, self.n_sketch_bins)
+
+    def __getstate__(self) -> dict:
+        """ Pickle the combined sketches """
+        self._compact()
+        return dict(self.__dict__)
+
+    def merge(self, other: 'BinnedStatistics') -> 'BinnedStatistics':
+        """ Combine with the statistics of other rows over the same bins """
+        if (other.n_bins, other.value_range, other.n_sketch_bins) != \
+                (self.n_bins, self.value_range, self.n_sketch_bins):
+            raise ValueError("Cannot merge statistics with different bins or sketches.")
+        self._combine(other.count, other.mean, other.m2)
+        self._add_cells(*other.sketch_cells())
+        return self
+
+    @property
+    def variance(self) -> numpy.array:
+        """ Unbiased variance of each bin (NaN with fewer than 2 values) """
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            return numpy.where(self.count > 1, self.m2 / (self.count - 1), numpy.nan)
+
+    def quantile(self, q: Union[float, Sequence[float]]) -> numpy.array:
+        """ Quantiles of each bin interpolated in the sketches (n_bins, len(q)) """
+        if not self.n_sketch_bins:
+            raise ValueError("Quantile sketches are disabled (n_sketch_bins=0).")
+        q = numpy.atleast_1d(q)
+        vmin, vmax = self.value_range
+        width = (vmax - vmin) / self.n_sketch_bins
+        result = numpy.full((self.n_bins, len(q)), numpy.nan)
+        keys, counts = self.sketch_cells()
+        if not len(keys):
+            return result
+        bins, cells = numpy.divmod(keys, self.n_sketch_bins)
+        # filled cells of each bin: keys[first[k]: last[k] + 1]
+        first = numpy.flatnonzero(numpy.concatenate([[True], bins[1:] != bins[:-1]]))
+        last = numpy.append(first[1:], len(keys)) - 1
+        cumulative = numpy.cumsum(counts)
+        offset = cumulative[first] - counts[first]
+        total = cumulative[last] - offset
+        for k, value in enumerate(q):
+            target = offset + value * total
+            # first cell reaching the target, interpolated linearly within the cell
+            index = numpy.clip(numpy.searchsorted(cumulative, target, side='left'), first, last)
+            fraction = (target - (cumulative[index] - counts[index])) / counts[index]
+            result[bins[first], k] = vmin + (cells[index] + numpy.clip(fraction, 0., 1.)) * width
+        return result
+
+    def to_frame(self, binning=None, quantiles: Sequence[float] = (0.16, 0.5, 0.84)) -> pandas.DataFrame:
+        """ Statistics of the non-empty bins
+
+        binning (e.g. :class:`HealpixBinning`) adds the columns describing
+        each bin; quantiles are added as 'q{value}' columns if sketches are enabled.
+        """
+        bins = numpy.flatnonzero(self.count)
+        columns = {'bin': bins}
+        if binning is not None:
+            columns.update(binning.coordinates(bins))
+        columns.update({'count': self.count[bins],
+                        'mean': self.mean[bins],
+                        'variance': self.variance[bins]})
+        if self.n_sketch_bins and len(quantiles):
+            values = self.quantile(quantiles)[bins]
+            for k, q in enumerate(quantiles):
+                columns[f'q{q:g}'] = values[:, k]
+        return pandas.DataFrame(columns)
+
+    def __repr__(self) -> str:
+        """ How it shows on the command line """
+        return "BinnedStatistics({0:d} bins, {1:d} values)".format(self.n_bins, int(self.count.sum()))
+
+
+def _aggregate_chunk(stats: BinnedStatistics, source: Union[str, pandas.DataFrame],
+                     binning, name: str, configuration_file: str, dtype: type,
+                     exclude_flags: int, b_unit: str = None) -> BinnedStatistics:
+    """ Calibrate a chunk and add it to the binned statistics """
+    df = read_partition(source).copy(deep=False)
+    b_unit = check_b_unit(df, b_unit)
+    model = get_collection(configuration_file)[name]
+    bins = binning(df)
+    if exclude_flags:
+        values, flags = model(df, dtype=dtype, return_flags=True, b_unit=b_unit)
+        bins = numpy.where(flags & exclude_flags, -1, bins)
+    else:
+        values = model(df, dtype=dtype, b_unit=b_unit)
+    return stats.update(bins, values)
+
+
+def _aggregation_worker(tasks, results, args: tuple, stats_args: tuple):
+    """ Worker process: one accumulator for all its chunks, returned once at the end """
+    stats = BinnedStatistics(*stats_args)
+    error = None
+    while True:
+        source = tasks.get()
+        if source is None:
+            break
+        if error is None:
+            try:
+                _aggregate_chunk(stats, source, *args)
+            except Exception as e:
+                # keep consuming the tasks so that the parent never blocks
+                error = e
+    results.put(stats if error is None else error)
+
+
+def _get_result(results, workers: list):
+    """ Next result of the workers; fails if a worker died without answering """
+    while True:
+        try:
+            return results.get(timeout=1.)
+        except queue.Empty:
+            if any((not worker.is_alive()) and worker.exitcode != 0 for worker in workers):
+                raise RuntimeError("An aggregation worker process died.")
+
+
+def aggregate_calibration(data: Union[pandas.DataFrame, Iterable, dict], binning,
+                          name: str = 'mh', configuration_file: str = None,
+                          chunk_size: int = 1_000_000,
+                          dtype: type = numpy.float64,
+                          exclude_flags: int = 0,
+                          value_range: Tuple[float, float] = (-5., 2.),
+                          n_sketch_bins: int = 350,
+                          n_workers: int = 1,
+                          b_unit: str = None) -> BinnedStatistics:
+    """ Calibrate data chunk by chunk and aggregate the values in bins
+
+    Parameters
+    ----------
+    data: pandas.DataFrame, iterable of pandas.DataFrame or dict
+        input data with the GACS column names, chunks of it (e.g. a
+        `pandas.read_csv(..., chunksize=...)` reader), or partitions
+        (partition name -> file name, DataFrame or source_id range, see :mod:`gdr3apcal.runner`)
+    binning: HealpixBinning or GridBinning
+        bin of each row
+    name: str
+        model to apply (default 'mh')
+    configuration_file: str
+        configuration of the models (default is the package configuration)
+    chunk_size: int
+        number of rows calibrated together when data is a single DataFrame
+    dtype: type
+        precision of the features and of the evaluation
+    exclude_flags: int
+        :class:`gdr3apcal.calibration_models.QualityFlag` bits of the rows to
+        ignore (e.g. `QualityFlag.OUTSIDE_TRAINING_DOMAIN`)
+    value_range: Tuple[float, float]
+        range of the quantile sketches
+    n_sketch_bins: int
+        histogram bins of the quantile sketches (0 disables them)
+    n_workers: int
+        number of processes. Each keeps a single accumulator for all its
+        chunks and returns it once, at the end.
+    b_unit: str
+        unit of b ('deg' or 'rad') if cos(b) is computed from it. Required
+        for chunks and partitions; guessed once for a single DataFrame.
+
+    returns
+    -------
+    stats: BinnedStatistics
+        aggregated statistics (see :meth:`BinnedStatistics.to_frame`)
+    """
+    if isinstance(data, pandas.DataFrame):
+        b_unit = resolve_b_unit(data, b_unit)
+        data = iter_chunks(data, chunk_size)
+    elif isinstance(data, dict):
+        data = iter(data.values())
+    n_workers = os.cpu_count() if n_workers is None else n_workers
+    args = (binning, name, configuration_file, dtype, exclude_flags, b_unit)
+    stats_args = (binning.n_bins, value_range, n_sketch_bins)
+    stats = BinnedStatistics(*stats_args)
+
+    if n_workers <= 1:
+        for chunk in data:
+            _aggregate_chunk(stats, chunk, *args)
+        return stats
+
+    # a bounded queue keeps a constant number of chunks in flight
+    context = multiprocessing.get_context()
+    tasks = context.Queue(maxsize=2 * n_workers)
+    results = context.Queue()
+    workers = [context.Process(target=_aggregation_worker, args=(tasks, results, args, stats_args),
+                               daemon=True)
+               for _ in range(n_workers)]
+    for worker in workers:
+        worker.start()
+    try:
+        for chunk in data:
+            tasks.put(chunk)
+        for _ in workers:
+            tasks.put(None)
+        errors = []
+        for _ in workers:
+            result = _get_result(results, workers)
+            if isinstance(result, Exception):
+                errors.append(result)
+            else:
+                stats.merge(result)
+        for worker in workers:
+            worker.join()
+    finally:
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+    if errors:
+        raise errors[0]
+    return stats
+
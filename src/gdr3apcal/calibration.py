@@ -4,11 +4,19 @@ import pandas
 import joblib
 import yaml
 import hashlib
-from typing import Sequence, Callable
+import zipfile
+import functools
+from typing import Sequence, Callable, Union
 # local code
-from .config import __PACKAGE_DIR__, modelsdir
+from .config import __PACKAGE_DIR__, modelsdir, cachedir
 from .repositories import registered_repositories
-from .calibration_models import CallableModel, CalibrationModel, SklearnModel, CalibrationModelGrouped
+from .calibration_models import (CallableModel, CalibrationModel, SklearnModel,
+                                 VectorizedMarsModel, CalibrationModelGrouped)
+from .mars_vectorized import VectorizedMarsFunction, compile_models, save_models, load_models
+from .dask_calibration import is_dask_dataframe, calibrate_partitions
+from .comparison import compare_versions
+from .aggregation import aggregate_calibration
+from .partitions import resolve_b_unit
 
 
 def _read_configuration(fname: str = None) -> dict:
@@ -59,6 +67,51 @@ def _check_model_files(name:str , modelfile:str , modelmd5sum: str):
         raise e
 
 
+def _callable_model(name: str, fn: Callable, features: Sequence[str], label: str) -> CalibrationModel:
+    """ Wrap a callable model
+    Exported MARS models are evaluated on arrays, other callables row by row.
+    """
+    if isinstance(fn, VectorizedMarsFunction):
+        return VectorizedMarsModel(name, fn, features, label)
+    return CallableModel(name, fn, features, label)
+
+
+def _compiled_artifact_file(name: str, modelfile: str) -> str:
+    """ Location of the compiled artifact of a callable model
+
+    The artifact is keyed by the checksum of the model source and the package version.
+    """
+    # local import: the version is defined after the package modules
+    from . import __VERSION__
+    hashinst = hashlib.sha256()
+    with open(modelfile, 'rb') as fin:
+        hashinst.update(fin.read())
+    hashinst.update(__VERSION__.encode('utf8'))
+    return os.path.join(cachedir, f'{name:s}-{hashinst.hexdigest()[:32]:s}.npz')
+
+
+def _load_callable_models(name: str, modelfile: str, module_name: str) -> dict:
+    """ Load the compiled callable models from the cache, or import and compile them once
+
+    A missing, truncated or corrupted artifact is compiled again and overwritten.
+    """
+    artifact = _compiled_artifact_file(name, modelfile)
+    try:
+        return load_models(artifact)
+    except (OSError, ValueError, KeyError, EOFError, zipfile.BadZipFile):
+        pass
+
+    import importlib
+    models = compile_models(importlib.import_module(module_name).models)
+    if all(isinstance(fn, VectorizedMarsFunction) for fn in models.values()):
+        try:
+            save_models(artifact, models)
+        except OSError as e:
+            # read-only cache: compile at every load
+            print(f"Could not cache model {name:s}: {e}")
+    return models
+
+
 def _load_model_from_configuration(name:str , config: dict) -> CalibrationModel:
     """ Load a model form the configuration file
     Decides which type of model to use given the model description
@@ -69,7 +122,7 @@ def _load_model_from_configuration(name:str , config: dict) -> CalibrationModel:
         """ Find the adapted class for the model definition """
         callable_model = model_config.get('callable', False)
         if callable_model:
-            return CallableModel
+            return _callable_model
         else:
             return SklearnModel
 
@@ -81,9 +134,8 @@ def _load_model_from_configuration(name:str , config: dict) -> CalibrationModel:
 
     try:
         if model_config.get('callable', False):
-            import importlib
             modulename = "gdr3apcal.models.{0:s}".format(model_config['filename'].replace('.py', ''))
-            model = importlib.import_module(modulename).models
+            model = _load_callable_models(name, modelfile, modulename)
         else:
             model = joblib.load(modelfile)
     except FileNotFoundError:
@@ -98,6 +150,9 @@ def _load_model_from_configuration(name:str , config: dict) -> CalibrationModel:
     label = model_config['label']
     groupby = model_config.get('groupby', False)
     mclass = model_type(model_config)
+    if mclass is SklearnModel:
+        # optional chunked prediction settings (n_jobs, chunk_size, backend)
+        mclass = functools.partial(SklearnModel, **model_config.get('prediction', {}))
 
     if not groupby:
         model = {name: mclass(name, fn, features, label) for name, fn in model.items()}
@@ -105,6 +160,19 @@ def _load_model_from_configuration(name:str , config: dict) -> CalibrationModel:
     else:   # Multi library
         model = {name: mclass(name, fn, features, label) for name, fn in model.items()}
         calib = CalibrationModelGrouped(name, model, features, label, groupby)
+
+    # training sample range used by the quality flags
+    domain = {k: tuple(v) for k, v in model_config.get('training_domain', {}).items()}
+    output_domain = model_config.get('label_domain', None)
+    for submodel in list(model.values()) + [calib]:
+        submodel.domain = domain
+        submodel.output_domain = None if output_domain is None else tuple(output_domain)
+
+    # per sub-model release tracking
+    for subname, entry in model_config.get('submodels', {}).items():
+        if subname in model and model[subname].checksum() != entry['md5sum']:
+            print(f"Model {subname:s} does not match the configuration. "
+                  f"Expecting {entry['md5sum']:s}, got {model[subname].checksum():s}")
     return calib
 
 
@@ -113,6 +181,7 @@ class GaiaDR3_GSPPhot_cal:
     """ Collection of calibration models for different GSP-Phot parameters. """
     def __init__(self, configuration_file: str = None):
         """ constructor """
+        self._configuration_file = configuration_file
         self._configuration = _read_configuration(configuration_file)
 
         # Private models are only loaded when first called.
@@ -128,9 +197,149 @@ class GaiaDR3_GSPPhot_cal:
             self._load_model(name)
         return self._models[name]
 
-    def calibrateMetallicity(self, pandas_data_frame: pandas.DataFrame):
-        """ apply model mh to the 'mh_gspphot' field """
-        return self['mh'](pandas_data_frame)
+    def calibrateMetallicity(self, pandas_data_frame: pandas.DataFrame,
+                             dtype: type = numpy.float64, return_flags: bool = False,
+                             b_unit: str = None):
+        """ apply model mh to the 'mh_gspphot' field
+
+        A dask DataFrame is calibrated lazily partition by partition and
+        returns a dask Series, or a dask DataFrame of the values and flags
+        with return_flags (see :func:`gdr3apcal.dask_calibration.calibrate_partitions`)
+
+        dtype=numpy.float32 evaluates the features and the model in single
+        precision (see :func:`gdr3apcal.precision.float32_deviation_report`
+        for the resulting deviations).
+
+        return_flags also returns the :class:`gdr3apcal.calibration_models.QualityFlag`
+        bits of each row (numpy.uint8), e.g. `values[flags == 0]` keeps the
+        sources within the validity range of the calibration.
+
+        b_unit ('deg' or 'rad') is the unit of the column b when cos(b) is
+        computed from it (default: guessed once from all the values of b).
+        """
+        if is_dask_dataframe(pandas_data_frame):
+            return calibrate_partitions(pandas_data_frame, 'mh', self._configuration_file,
+                                        b_unit=b_unit, dtype=dtype, return_flags=return_flags)
+        return self['mh'](pandas_data_frame, dtype=dtype, return_flags=return_flags, b_unit=b_unit)
+
+    def aggregateMetallicity(self, data, binning, chunk_size: int = 1_000_000,
+                             exclude_flags: int = 0, n_workers: int = 1, **kwargs):
+        """ Calibrate mh chunk by chunk and aggregate it in bins without keeping the values
+
+        binning is a :class:`gdr3apcal.aggregation.HealpixBinning` (sky maps from
+        the source_id) or a :class:`gdr3apcal.aggregation.GridBinning` (feature
+        grids, e.g. Teff-logg). Returns mergeable
+        :class:`gdr3apcal.aggregation.BinnedStatistics` (counts, means, variances
+        and quantiles per bin); see :func:`gdr3apcal.aggregation.aggregate_calibration`
+        for the other options.
+        """
+        return aggregate_calibration(data, binning, 'mh', self._configuration_file,
+                                     chunk_size=chunk_size, exclude_flags=exclude_flags,
+                                     n_workers=n_workers, **kwargs)
+
+    def subModelVersions(self, name: str = 'mh') -> dict:
+        """ Version and checksum of each sub-model (e.g. library) of a model
+
+        The version comes from the `submodels` entry of the configuration
+        (default: version of the model), the checksum from the loaded sub-model.
+        Store this with calibrated outputs to update them with :meth:`updateCalibration`.
+        """
+        model = self[name]
+        submodels = model.model if isinstance(model, CalibrationModelGrouped) else {name: model}
+        declared = self._configuration[name].get('submodels', {})
+        version = str(self._configuration[name]['version'])
+        return {subname: {'version': str(declared.get(subname, {}).get('version', version)),
+                          'md5sum': submodel.checksum()}
+                for subname, submodel in submodels.items()}
+
+    def updateCalibration(self, calibrated_data_frame: pandas.DataFrame,
+                          previous_versions: dict, name: str = 'mh',
+                          column: str = None, b_unit: str = None) -> numpy.array:
+        """ Recompute in place only the rows whose sub-model changed
+
+        Parameters
+        ----------
+        calibrated_data_frame: pandas.DataFrame
+            data with the input features and a column of calibrated values
+        previous_versions: dict
+            :meth:`subModelVersions` of the release that produced the values
+        name: str
+            model to apply (default 'mh')
+        column: str
+            column of calibrated values (default '{name}_calibrated')
+        b_unit: str
+            unit of b ('deg' or 'rad') if cos(b) is computed from it
+            (default: guessed from all the rows, not only the updated ones)
+
+        returns
+        -------
+        updated: numpy.array
+            boolean mask of the recomputed rows
+        """
+        column = name + '_calibrated' if column is None else column
+        model = self[name]
+        current = self.subModelVersions(name)
+        changed = [subname for subname in current if previous_versions.get(subname) != current[subname]]
+        if not isinstance(model, CalibrationModelGrouped):
+            updated = numpy.full(len(calibrated_data_frame), bool(changed))
+        else:
+            slots = [k for k, subname in enumerate(model.model) if subname in changed]
+            updated = numpy.isin(model.library_codes(calibrated_data_frame[model.groupby]), slots)
+        if updated.any():
+            rows = numpy.flatnonzero(updated)
+            b_unit = resolve_b_unit(calibrated_data_frame, b_unit)
+            values = model(calibrated_data_frame.iloc[rows].copy(deep=False), b_unit=b_unit)
+            calibrated_data_frame.iloc[rows, calibrated_data_frame.columns.get_loc(column)] = values
+        return updated
+
+    def compareVersions(self, data, configurations: Union[dict, Sequence[str]],
+                        name: str = 'mh', chunk_size: int = 1_000_000,
+                        dtype: type = numpy.float64, return_values: bool = True,
+                        b_unit: str = None) -> tuple:
+        """ Evaluate other releases side by side with this one in a single pass
+
+        Parameters
+        ----------
+        data: pandas.DataFrame or iterable of pandas.DataFrame
+            input data with the GACS column names, or chunks of it
+        configurations: dict or Sequence[str]
+            configuration files of the other releases, as {label: file} or a
+            list of files labelled by the version of their model
+        name: str
+            model to compare (default 'mh')
+        chunk_size: int
+            number of rows evaluated together
+        dtype: type
+            precision of the features and of the evaluation
+        return_values: bool
+            if False, only the statistics of the differences are computed
+        b_unit: str
+            unit of b ('deg' or 'rad') if cos(b) is computed from it
+            (required for chunks, guessed once for a single DataFrame)
+
+        returns
+        -------
+        values: pandas.DataFrame
+            one column per release, labelled by version (None if not return_values)
+        stats: pandas.DataFrame
+            count, mean, RMS and maximum absolute difference of each other
+            release to this one (see :func:`gdr3apcal.comparison.compare_versions`)
+        """
+        if not isinstance(configurations, dict):
+            configurations = {str(_read_configuration(fname)[name]['version']): fname
+                              for fname in configurations}
+        models = {str(self._configuration[name]['version']): self[name]}
+        for label, fname in configurations.items():
+            if str(label) in models:
+                raise ValueError(f"Duplicate version label {label}. Use a dictionary of configurations.")
+            models[str(label)] = GaiaDR3_GSPPhot_cal(fname)[name]
+        return compare_versions(data, models, chunk_size=chunk_size, dtype=dtype,
+                                return_values=return_values, b_unit=b_unit)
+
+    def shutdown(self):
+        """ Release the worker pools of the loaded models """
+        for model in self._models.values():
+            model.shutdown()
 
     def __repr__(self) -> str:
         """ How it shows on the command line """
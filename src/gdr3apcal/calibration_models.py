@@ -1,19 +1,44 @@
 """ Interfaces to various flavors of models """
+import os
+import enum
+import hashlib
+import inspect
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 import numpy
 import pandas
-from typing import Sequence, Union, Callable
-from astropy import units as u
-from astropy.coordinates import SkyCoord
-from sklearn.base import BaseEstimator
+import joblib
+from typing import Sequence, Union, Callable, TYPE_CHECKING
+# local code
+from .mars_vectorized import VectorizedMarsFunction
 
+if TYPE_CHECKING:   # scikit-learn and astropy are slow to import, only load them when needed
+    from sklearn.base import BaseEstimator
 
-__all__ = ['CalibrationModel', 'SklearnModel', 'CallableModel', 'CalibrationModelGrouped']
+
+__all__ = ['QualityFlag', 'CalibrationModel', 'SklearnModel', 'CallableModel',
+           'VectorizedMarsModel', 'CalibrationModelGrouped']
+
+
+class QualityFlag(enum.IntFlag):
+    """ Bits of the quality flags (numpy.uint8) returned with the calibrated values
+
+    A flag of 0 means the calibration applies. Flags combine, e.g. use
+    `flags & QualityFlag.EXTRAPOLATION` to select a given condition.
+    """
+    NAN_INPUT = 1                   # at least one feature is NaN (no calibration)
+    UNCALIBRATED_LIBRARY = 2        # no calibration for this library (e.g. A, OB)
+    OUTSIDE_TRAINING_DOMAIN = 4     # input or calibrated value outside the training sample range
+    EXTRAPOLATION = 8               # a feature lies beyond the outer knots of the model
 
 
 class CalibrationModel:
     """ single generic model wrapper """
+    # range of the training sample per feature {feature: (min, max)}
+    domain = {}
+    # range of the training labels (min, max) checked on the calibrated values
+    output_domain = None
 
-    def __init__(self, name: str, model: Union[Callable, BaseEstimator], 
+    def __init__(self, name: str, model: Union[Callable, 'BaseEstimator'], 
                  features: Sequence[str], label:str):
         """ Constructor """
         self.name = name
@@ -22,43 +47,65 @@ class CalibrationModel:
         self.label = label
 
     @staticmethod
-    def compute_cosb_from_dataframe(df: pandas.DataFrame) -> numpy.array:
+    def guess_b_unit(b: numpy.array) -> str:
+        """ Unit of the Galactic latitudes b: 'deg' if any |b| > pi/2, otherwise 'rad'
+
+        The guess depends on the data: make it once on the full data set,
+        never on parts of it (a part close to the Galactic plane looks like radians).
+        """
+        return 'deg' if numpy.nanmax(numpy.abs(b)) > numpy.pi / 2 else 'rad'
+
+    @classmethod
+    def compute_cosb_from_dataframe(cls, df: pandas.DataFrame, dtype: type = numpy.float64,
+                                    b_unit: str = None) -> numpy.array:
         """ Infers from the data how to compute cos(b) 
 
-        Checks if b is provided (test degrees or radians). 
+        Checks if b is provided, in the unit b_unit ('deg' or 'rad'; guessed
+        from the data by default, see :meth:`guess_b_unit`).
         If not attempts from ra, dec with conversion to Galactic coordinates
         """
+        dtype = numpy.dtype(dtype)
         # If b is available, compute it automatically but inform the user that units are assumed.
         if ('b' in df.columns):
-            # If 'b' is in degrees, it could be larger than pi/2
-            if (numpy.nanmax(numpy.abs(df['b'])) > numpy.pi / 2):
-                # 'b' definitely comes in degrees.
-                print('Automatically adding "cos(b)" from "b" [assuming degrees].')
-                cosb = numpy.cos(df['b'] * numpy.pi / 180)
+            b = numpy.asarray(df['b'], dtype=dtype)
+            if b_unit is None:
+                b_unit = cls.guess_b_unit(b)
+                print('Automatically adding "cos(b)" from "b" [assuming {0:s}].'.format(
+                    'degrees' if b_unit == 'deg' else 'radians'))
+            if b_unit == 'deg':
+                cosb = numpy.cos(b * dtype.type(numpy.pi / 180))
+            elif b_unit == 'rad':
+                cosb = numpy.cos(b)
             else:
-                # 'b' probably comes in radians.
-                print('Automatically adding "cos(b)" from "b" [assuming radians].')
-                cosb = numpy.cos(df['b'])   
+                raise ValueError(f"Unknown unit of b {b_unit!r}. Expecting 'deg' or 'rad'.")
         elif (('ra' in df.columns) and ('dec' in df.columns)):
             # Convert to Galactic coordinates
             print('Automatically adding cos(b) from given ra and dec assuming degrees.')
+            from astropy import units as u
+            from astropy.coordinates import SkyCoord
             ra = numpy.array(df['ra']) * u.degree
             dec = numpy.array(df['dec']) * u.degree
             c = SkyCoord(ra=ra, dec=dec, frame='icrs')
-            cosb = numpy.cos(c.galactic.b.radian)
+            cosb = numpy.cos(c.galactic.b.radian).astype(dtype)
         else:
             # No positional information available. Throw an error.
             raise KeyError("Your data does not contain positions. Please provide either Galactic latitude b, cosb, or ra+dec.")
         return cosb
 
     @classmethod
-    def _get_features(cls, df: pandas.DataFrame, names: Sequence[str]) -> numpy.array:
-        """ Extract features from pandas array and return what we need """
+    def _get_features(cls, df: pandas.DataFrame, names: Sequence[str],
+                      dtype: type = numpy.float64, b_unit: str = None,
+                      out: numpy.array = None) -> numpy.array:
+        """ Extract features from pandas array and return what we need
+
+        out is an optional (n_rows, n_features) array to fill instead of a new one.
+        """
         # if cosb is required but missing, add it.
         # store cosb in the data for further use.
         if (('cosb' in names) and ('cosb' not in df.columns)):
-            # this insert operation is not relying on pandas
-            df['cosb'] = cls.compute_cosb_from_dataframe(df)
+            # this insert operation is not relying on pandas.
+            # always in full precision: later float64 calls reuse the column
+            df['cosb'] = cls.compute_cosb_from_dataframe(df, numpy.float64, b_unit)
 
         # Loop over required feature names and check if they are available in pandas data frame.
         # If not, add them to the list of missing names.
@@ -67,60 +114,178 @@ class CalibrationModel:
         if missing:
             # If any feature names are missing from pandas data frame, raise an error with a list of all missing names.
             raise KeyError("Missing features from input data: {0:s}".format(','.join(missing)))
-        
-        return numpy.array([df[k] for k in names]).T 
-    
-    def __call__(self, df: pandas.DataFrame) -> numpy.array:
-        """ call the model like a function """
-        # Build the feature vector as input for calibration model.
-        # X = self._get_features(df, self.features)
 
-        # Check for NaN features.
-        #row_without_nan = numpy.isfinite(X).all(axis=1)
+        # fill the feature matrix directly with the requested precision
+        X = numpy.empty((len(df), len(names)), dtype=dtype) if out is None else out
+        for k, name in enumerate(names):
+            X[:, k] = df[name].values
+        return X
 
-        # array with calibrated values. rows with nan values get nan calibration.
-        #calibrated_values = numpy.zeros(len(X)) + numpy.nan
-        
-        # The calibration is trained on the differences value_gspphot - value_literature
-        # Applying the calibration to GSPPhot values therefore works as:
-        # value_calibrated = value_gspphot - calibration
-        #calibrated_values[row_without_nan] = df[self.label].values[row_without_nan] - self.model.predict(X[row_without_nan])
+    @property
+    def calibrated(self) -> bool:
+        """ False when the model does not provide a calibration """
+        return True
+
+    def checksum(self) -> str:
+        """ Checksum of the model content, used to track changes between releases """
+        return joblib.hash(self.model)
+
+    def shutdown(self):
+        """ Release the resources held by the model or its sub-models (e.g. worker pools) """
+        if isinstance(self.model, dict):
+            for model in self.model.values():
+                model.shutdown()
 
-        #return calibrated_values
+    def _quality_flags(self, X: numpy.array, row_without_nan: numpy.array,
+                       calibrated_values: numpy.array, flags: numpy.array):
+        """ Set the quality flags that do not depend on the model type """
+        flags[~row_without_nan] |= numpy.uint8(QualityFlag.NAN_INPUT)
+        if not self.calibrated:
+            flags |= numpy.uint8(QualityFlag.UNCALIBRATED_LIBRARY)
+        outside = numpy.zeros(len(X), dtype=bool)
+        for name, (vmin, vmax) in self.domain.items():
+            x = X[:, self.features.index(name)]
+            outside |= (x < vmin) | (x > vmax)
+        if self.output_domain is not None:
+            vmin, vmax = self.output_domain
+            outside |= (calibrated_values < vmin) | (calibrated_values > vmax)
+        flags[outside] |= numpy.uint8(QualityFlag.OUTSIDE_TRAINING_DOMAIN)
+
+    def evaluate(self, X: numpy.array, values: numpy.array, flags: numpy.array = None) -> numpy.array:
+        """ Calibrate values given the feature matrix X
+
+        The calibration is trained on the differences value_gspphot - value_literature
+        Applying the calibration to GSPPhot values therefore works as:
+        value_calibrated = value_gspphot - calibration
+        Rows with NaN features get NaN calibration.
+
+        If given, the uint8 array `flags` is updated in place with the
+        :class:`QualityFlag` bits of each row.
+        """
         raise NotImplementedError("Use a derived class")
+
+    def __call__(self, df: pandas.DataFrame, dtype: type = numpy.float64,
+                 return_flags: bool = False, b_unit: str = None) -> numpy.array:
+        """ call the model like a function
+
+        dtype sets the precision of the features and of the evaluation
+        (float64 by default, float32 halves the memory traffic).
+        With return_flags, also returns the :class:`QualityFlag` bits of each
+        row as a numpy.uint8 array, computed in the same pass.
+        b_unit ('deg' or 'rad') is the unit of b when cos(b) is computed from it.
+        """
+        # Build the feature vector as input for calibration model.
+        X = self._get_features(df, self.features, dtype, b_unit)
+        flags = numpy.zeros(len(X), dtype=numpy.uint8) if return_flags else None
+        calibrated_values = self.evaluate(X, numpy.asarray(df[self.label].values, dtype=dtype), flags)
+        if return_flags:
+            return calibrated_values, flags
+        return calibrated_values
         
     def __repr__(self) -> str:
         """ How it shows on the command line """
         return "Calibration Model '{s.name}':\n    ({s.features}) -> {s.label}".format(s=self)
 
 
+# estimator of the prediction worker processes (set once per process)
+_process_estimator = None
+
+
+def _init_process_estimator(estimator: 'BaseEstimator'):
+    """ Initializer of the prediction worker processes """
+    global _process_estimator
+    _process_estimator = estimator
+
+
+def _predict_with_process_estimator(X: numpy.array) -> numpy.array:
+    """ Prediction of a chunk in a worker process """
+    return _process_estimator.predict(X)
+
+
 class SklearnModel(CalibrationModel):
-    """ Using a BaseEstimator API (.predict) """
+    """ Using a BaseEstimator API (.predict)
+
+    Large inputs can be predicted in chunks over a pool of workers:
+    n_jobs sets the number of workers (-1 for all cpus, 1 is sequential),
+    chunk_size the number of rows per prediction call, and backend the type of
+    pool: 'thread' for estimators releasing the GIL (most compiled
+    estimators), 'process' otherwise.
+
+    The pool is created on the first parallel prediction and kept for the
+    following ones, so that the estimator is sent only once to each worker
+    process. Release it with :meth:`shutdown`.
+    """
     
-    def __init__(self, name: str, model: BaseEstimator, 
-                 features: Sequence[str], label:str):
+    def __init__(self, name: str, model: 'BaseEstimator', 
+                 features: Sequence[str], label:str,
+                 n_jobs: int = 1, chunk_size: int = 100_000, backend: str = 'thread'):
         """ Constructor """
+        if backend not in ('thread', 'process'):
+            raise ValueError(f"Unknown backend {backend}. Expecting 'thread' or 'process'")
         self.name = name
         self.model = model
         self.features = features
         self.label = label
+        self.n_jobs = n_jobs
+        self.chunk_size = chunk_size
+        self.backend = backend
+        self._executor = None
+        self._executor_workers = 0
 
-    def __call__(self, df: pandas.DataFrame) -> numpy.array:
-        """ call the model like a function """
-        # Build the feature vector as input for calibration model.
-        X = self._get_features(df, self.features)
+    def _get_executor(self, n_jobs: int):
+        """ Pool of workers, created once and reused by later predictions """
+        if self._executor is None or self._executor_workers != n_jobs:
+            self.shutdown()
+            if self.backend == 'thread':
+                self._executor = ThreadPoolExecutor(max_workers=n_jobs)
+            else:
+                self._executor = ProcessPoolExecutor(max_workers=n_jobs,
+                                                     initializer=_init_process_estimator,
+                                                     initargs=(self.model,))
+            self._executor_workers = n_jobs
+        return self._executor
 
+    def shutdown(self):
+        """ Stop the pool of workers (a later prediction starts a new one) """
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+            self._executor_workers = 0
+
+    def __getstate__(self) -> dict:
+        """ Pickle without the pool of workers """
+        state = dict(self.__dict__)
+        state['_executor'] = None
+        state['_executor_workers'] = 0
+        return state
+
+    def predict(self, X: numpy.array) -> numpy.array:
+        """ model predictions, split in chunks over the workers and reassembled in order """
+        n_jobs = os.cpu_count() if self.n_jobs == -1 else self.n_jobs
+        if (n_jobs <= 1) or (len(X) <= self.chunk_size):
+            return self.model.predict(X)
+
+        chunks = [X[start: start + self.chunk_size] for start in range(0, len(X), self.chunk_size)]
+        pool = self._get_executor(n_jobs)
+        if self.backend == 'thread':
+            return numpy.concatenate(list(pool.map(self.model.predict, chunks)))
+        return numpy.concatenate(list(pool.map(_predict_with_process_estimator, chunks)))
+
+    def evaluate(self, X: numpy.array, values: numpy.array, flags: numpy.array = None) -> numpy.array:
+        """ Calibrate values given the feature matrix X """
         # Check for NaN features.
         row_without_nan = numpy.isfinite(X).all(axis=1)
 
         # array with calibrated values. rows with nan values get nan calibration.
-        calibrated_values = numpy.zeros(len(X)) + numpy.nan
+        calibrated_values = numpy.full(len(X), numpy.nan, dtype=X.dtype)
         
         # The calibration is trained on the differences value_gspphot - value_literature
         # Applying the calibration to GSPPhot values therefore works as:
         # value_calibrated = value_gspphot - calibration
-        calibrated_values[row_without_nan] = df[self.label].values[row_without_nan] - self.model.predict(X[row_without_nan])
+        calibrated_values[row_without_nan] = values[row_without_nan] - self.predict(X[row_without_nan])
 
+        if flags is not None:
+            self._quality_flags(X, row_without_nan, calibrated_values, flags)
         return calibrated_values
 
 
@@ -135,28 +300,87 @@ class CallableModel(CalibrationModel):
         self.features = features
         self.label = label
     
-    def __call__(self, df:pandas.DataFrame):
-        # Build the feature vector as input for calibration model.
-        X = self._get_features(df, self.features)
+    def checksum(self) -> str:
+        """ Checksum of the source code of the callable (if available) """
+        try:
+            return hashlib.sha256(inspect.getsource(self.model).encode('utf8')).hexdigest()
+        except (OSError, TypeError):
+            return super().checksum()
 
+    def evaluate(self, X: numpy.array, values: numpy.array, flags: numpy.array = None) -> numpy.array:
+        """ Calibrate values given the feature matrix X """
         # Check for NaN features.
         row_without_nan = numpy.isfinite(X).all(axis=1)
 
         # array with calibrated values. rows with nan values get nan calibration.
-        calibrated_values = numpy.zeros(len(X)) + numpy.nan
+        calibrated_values = numpy.full(len(X), numpy.nan, dtype=X.dtype)
         
         # The calibration is trained on the differences value_gspphot - value_literature
         # Applying the calibration to GSPPhot values therefore works as:
         # value_calibrated = value_gspphot - calibration
-        pred = numpy.array(list(self.model(X[row_without_nan])))
-        calibrated_values[row_without_nan] = df[self.label].values[row_without_nan] - pred
+        pred = numpy.array(list(self.model(X[row_without_nan])), dtype=X.dtype)
+        calibrated_values[row_without_nan] = values[row_without_nan] - pred
 
+        if flags is not None:
+            self._quality_flags(X, row_without_nan, calibrated_values, flags)
+        return calibrated_values
+
+
+class VectorizedMarsModel(CalibrationModel):
+    """ MARS model evaluated on arrays (see :class:`gdr3apcal.mars_vectorized.VectorizedMarsFunction`) """
+
+    def __init__(self, name: str, model: VectorizedMarsFunction,
+                 features: Sequence[str], label:str):
+        """ Constructor """
+        self.name = name
+        self.model = model
+        self.features = features
+        self.label = label
+
+    @property
+    def calibrated(self) -> bool:
+        """ False for the libraries without calibration """
+        return self.model.calibrated
+
+    def checksum(self) -> str:
+        """ Checksum of the model parameters """
+        return self.model.checksum()
+
+    def _outer_knots(self, n_features: int) -> tuple:
+        """ lowest and highest knots per feature column (-inf, inf when unused) """
+        vmin = numpy.full(n_features, -numpy.inf)
+        vmax = numpy.full(n_features, numpy.inf)
+        for index, (low, high) in self.model.domain().items():
+            vmin[index], vmax[index] = low, high
+        return vmin, vmax
+
+    def evaluate(self, X: numpy.array, values: numpy.array, flags: numpy.array = None) -> numpy.array:
+        """ Calibrate values given the feature matrix X """
+        # Check for NaN features.
+        row_without_nan = numpy.isfinite(X).all(axis=1)
+
+        # array with calibrated values. rows with nan values get nan calibration.
+        calibrated_values = numpy.full(len(X), numpy.nan, dtype=X.dtype)
+
+        if self.model.calibrated:
+            # value_calibrated = value_gspphot - calibration
+            pred = self.model(X[row_without_nan])
+            calibrated_values[row_without_nan] = values[row_without_nan] - pred
+
+        if flags is not None:
+            self._quality_flags(X, row_without_nan, calibrated_values, flags)
+            if self.model.calibrated:
+                vmin, vmax = self._outer_knots(X.shape[1])
+                flags[((X < vmin) | (X > vmax)).any(axis=1)] |= numpy.uint8(QualityFlag.EXTRAPOLATION)
         return calibrated_values
 
 
 class CalibrationModelGrouped(CalibrationModel):
     """ A convenient collection of models that apply on grouped data 
     This is used to handle the individual calibrations of the spectral libraries of GSP-Phot.
+
+    The library of each row is handled as a small integer code, the index
+    of its model in `libraries` (see :meth:`library_codes`).
     """
     def __init__(self, name:str, 
                  models: dict, 
@@ -170,12 +394,102 @@ class CalibrationModelGrouped(CalibrationModel):
         self.model = models
         for model in models.values():
             model.features = [k for k in model.features if k != groupby]
-    
-    def __call__(self, df: pandas.DataFrame) -> numpy.array:
-        predictions = numpy.empty(len(df))
+        # model slots: library names (lower case) in the order of the models
+        prefix = self.name + '_'
+        self.libraries = [key[len(prefix):] if key.startswith(prefix) else key for key in models]
+        self._slots = list(models.values())
+        self._slot_of = {library: k for k, library in enumerate(self.libraries)}
+
+    def _slots_of_names(self, names: Sequence) -> numpy.array:
+        """ slot of each library name (-1 for missing values, -2 for unknown names) """
+        slots = numpy.empty(len(names), dtype=numpy.int8)
+        for k, library in enumerate(names):
+            if library is None or (isinstance(library, float) and numpy.isnan(library)):
+                slots[k] = -1
+            else:
+                slots[k] = self._slot_of.get(str(library).lower(), -2)
+        return slots
+
+    def library_codes(self, column: Union[pandas.Series, numpy.array]) -> numpy.array:
+        """ Library of each row as the index of its model in `libraries` (numpy.int8)
+
+        Accepts library names (strings, pandas Categorical or Arrow
+        dictionary-encoded columns) and integer codes (already model indices).
+        Missing values get the code -1 (integer codes: -1 or NA); other
+        negative or too large integer codes raise a KeyError.
+        """
+        if not isinstance(column, pandas.Series):
+            column = pandas.Series(column)
+        if pandas.api.types.is_integer_dtype(column.dtype):
+            # nullable integers (e.g. Int8 from parquet): NA is a missing library
+            codes = column.to_numpy(dtype='int64', na_value=-1)
+            invalid = (codes < -1) | (codes >= len(self.libraries))
+            if invalid.any():
+                raise KeyError("Invalid library codes: {0:s}. Expecting codes of {1:s} or -1".format(
+                    ','.join(map(str, numpy.unique(codes[invalid]))), ','.join(self.libraries)))
+            return codes.astype(numpy.int8)
+
+        if isinstance(column.dtype, pandas.CategoricalDtype):
+            codes, names = column.cat.codes.values, column.cat.categories
+        else:
+            # hashes the strings once; only the few unique names are mapped to slots
+            codes, names = pandas.factorize(column)
+        slots = numpy.append(self._slots_of_names(list(names)), numpy.int8(-1))
+        codes = slots[codes]   # code -1 picks the appended missing slot
+        unknown = [library for library, slot in zip(names, slots) if slot == -2]
+        if unknown and (codes == -2).any():
+            raise KeyError("Unknown GSP-Phot libraries: {0:s}. Expecting one of {1:s}".format(
+                ','.join(map(str, unknown)), ','.join(self.libraries)))
+        return codes
+
+    def encode_libraries(self, column: Union[pandas.Series, numpy.array]) -> pandas.Categorical:
+        """ Compact categorical library column whose codes are the model slots """
+        return pandas.Categorical.from_codes(self.library_codes(column),
+                                             categories=[library.upper() for library in self.libraries])
+
+    def partition(self, codes: numpy.array) -> tuple:
+        """ Rows of each library: (order, bounds)
+
+        `order[bounds[k + 1]: bounds[k + 2]]` are the rows of slot k, and
+        `order[bounds[0]: bounds[1]]` the rows without library.
+        """
+        # sorting the small integer codes gives the rows of each library
+        order = numpy.argsort(codes, kind='stable')
+        bounds = numpy.searchsorted(codes[order], numpy.arange(-1, len(self._slots) + 1))
+        return order, bounds
+
+    def evaluate_codes(self, X: numpy.array, values: numpy.array, codes: numpy.array,
+                       flags: numpy.array = None, partition: tuple = None) -> numpy.array:
+        """ Calibrate values given the feature matrix X and the library codes
+
+        partition is the result of :meth:`partition` of the codes, if already computed.
+        """
+        predictions = numpy.empty(len(X), dtype=X.dtype)
         predictions.fill(float('nan'))
 
-        for name, data in df.groupby(self.groupby):
-            r = self.model[self.name + '_' + name.lower()](data)
-            predictions[data.index.values] = r
-        return predictions
\ No newline at end of file
+        order, bounds = self.partition(codes) if partition is None else partition
+        if flags is not None:
+            flags[order[bounds[0]: bounds[1]]] |= numpy.uint8(QualityFlag.NAN_INPUT)
+        for slot, model in enumerate(self._slots):
+            indices = order[bounds[slot + 1]: bounds[slot + 2]]
+            if not len(indices):
+                continue
+            group_flags = numpy.zeros(len(indices), dtype=numpy.uint8) if flags is not None else None
+            predictions[indices] = model.evaluate(X[indices], values[indices], group_flags)
+            if flags is not None:
+                flags[indices] |= group_flags
+        return predictions
+
+    def __call__(self, df: pandas.DataFrame, dtype: type = numpy.float64,
+                 return_flags: bool = False, b_unit: str = None) -> numpy.array:
+        """ call the model like a function (see :meth:`CalibrationModel.__call__`) """
+        codes = self.library_codes(df[self.groupby])
+        # features are extracted once and shared by all libraries
+        X = self._get_features(df, self.features, dtype, b_unit)
+        values = numpy.asarray(df[self.label].values, dtype=dtype)
+
+        flags = numpy.zeros(len(df), dtype=numpy.uint8) if return_flags else None
+        predictions = self.evaluate_codes(X, values, codes, flags)
+        if return_flags:
+            return predictions, flags
+        return predictions
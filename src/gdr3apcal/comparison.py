@@ -0,0 +1,169 @@
+""" Side-by-side evaluation of several calibration releases
+
+Validating a new release means comparing its calibration with the current
+one on the same (large) data. Instead of one full pass per release, the
+releases are evaluated together chunk by chunk: the feature matrix, the
+labels and the library partition are computed once per chunk and shared by
+all the models that use the same features and libraries. The differences to
+the reference release are accumulated on the fly, so that the per-release
+outputs do not need to be kept.
+
+.. code-block:: python
+
+    from gdr3apcal import GaiaDR3_GSPPhot_cal
+    calib = GaiaDR3_GSPPhot_cal()
+    values, stats = calib.compareVersions(df, {'candidate': 'candidate.yaml'})
+"""
+from typing import Iterable
+import numpy
+import pandas
+# local code
+from .calibration_models import CalibrationModelGrouped
+from .partitions import iter_chunks, resolve_b_unit, check_b_unit
+
+
+__all__ = ['DifferenceStatistics', 'compare_versions']
+
+
+class DifferenceStatistics:
+    """ Streaming statistics of the differences `other - reference`
+
+    Only rows where both values are finite contribute to the statistics;
+    rows where only one of the two values is NaN are counted separately.
+    Partial statistics (e.g. of parallel workers) combine with :meth:`merge`.
+    """
+
+    def __init__(self):
+        """ Constructor """
+        self.n = 0
+        self.sum = 0.
+        self.sum_squares = 0.
+        self.max_abs = 0.
+        self.nan_mismatch = 0
+
+    def update(self, reference: numpy.array, other: numpy.array) -> 'DifferenceStatistics':
+        """ Add the differences of a chunk """
+        reference_ok = numpy.isfinite(reference)
+        other_ok = numpy.isfinite(other)
+        self.nan_mismatch += int(numpy.count_nonzero(reference_ok != other_ok))
+        # accumulate in float64 whatever the evaluation precision
+        diff = numpy.asarray(other[reference_ok & other_ok], dtype=numpy.float64) - \
+            reference[reference_ok & other_ok]
+        if len(diff):
+            self.n += len(diff)
+            self.sum += float(diff.sum())
+            self.sum_squares += float(numpy.dot(diff, diff))
+            self.max_abs = max(self.max_abs, float(numpy.abs(diff).max()))
+        return self
+
+    def merge(self, other: 'DifferenceStatistics') -> 'DifferenceStatistics':
+        """ Combine with the statistics of other rows """
+        self.n += other.n
+        self.sum += other.sum
+        self.sum_squares += other.sum_squares
+        self.max_abs = max(self.max_abs, other.max_abs)
+        self.nan_mismatch += other.nan_mismatch
+        return self
+
+    def result(self) -> dict:
+        """ n, mean, rms and maximum absolute difference, and NaN mismatches """
+        if self.n:
+            mean = self.sum / self.n
+            rms = numpy.sqrt(self.sum_squares / self.n)
+            max_abs = self.max_abs
+        else:
+            mean = rms = max_abs = float('nan')
+        return {'n': self.n, 'mean': mean, 'rms': rms,
+                'max_abs': max_abs, 'nan_mismatch': self.nan_mismatch}
+
+    def __repr__(self) -> str:
+        """ How it shows on the command line """
+        return "DifferenceStatistics({0})".format(self.result())
+
+
+def _evaluate_chunk(df: pandas.DataFrame, models: dict, dtype: type, b_unit: str = None) -> dict:
+    """ Evaluate all models on a chunk, sharing features, labels and library partitions """
+    b_unit = check_b_unit(df, b_unit)
+    features, labels, partitions = {}, {}, {}
+    results = {}
+    for key, model in models.items():
+        names = tuple(model.features)
+        if names not in features:
+            features[names] = model._get_features(df, model.features, dtype, b_unit)
+        X = features[names]
+        if model.label not in labels:
+            labels[model.label] = numpy.asarray(df[model.label].values, dtype=dtype)
+        values = labels[model.label]
+        if isinstance(model, CalibrationModelGrouped):
+            libraries = (model.groupby, tuple(model.libraries))
+            if libraries not in partitions:
+                codes = model.library_codes(df[model.groupby])
+                partitions[libraries] = (codes, model.partition(codes))
+            codes, partition = partitions[libraries]
+            results[key] = model.evaluate_codes(X, values, codes, partition=partition)
+        else:
+            results[key] = model.evaluate(X, values)
+    return results
+
+
+def compare_versions(data: Iterable[pandas.DataFrame], models: dict,
+                     chunk_size: int = 1_000_000,
+                     dtype: type = numpy.float64,
+                     return_values: bool = True,
+                     b_unit: str = None) -> tuple:
+    """ Evaluate several models in one pass and compare them to the first one
+
+    Parameters
+    ----------
+    data: pandas.DataFrame or iterable of pandas.DataFrame
+        input data with the GACS column names, or chunks of it (e.g. a
+        `pandas.read_csv(..., chunksize=...)` reader)
+    models: dict
+        {label: CalibrationModel}; the first model is the reference
+    chunk_size: int
+        number of rows evaluated together when data is a single DataFrame
+    dtype: type
+        precision of the features and of the evaluation
+    return_values: bool
+        if False, only the statistics are kept (constant memory)
+    b_unit: str
+        unit of b ('deg' or 'rad') if cos(b) is computed from it. Required
+        for chunks; guessed once for a single DataFrame.
+
+    returns
+    -------
+    values: pandas.DataFrame
+        one column per model (None if not return_values)
+    stats: pandas.DataFrame
+        statistics of the differences to the reference, one row per other model
+        (see :class:`DifferenceStatistics`)
+    """
+    labels = list(models)
+    if not labels:
+        raise ValueError("Expecting at least one model")
+    reference = labels[0]
+    stats = {key: DifferenceStatistics() for key in labels[1:]}
+
+    index = None
+    if isinstance(data, pandas.DataFrame):
+        index = data.index
+        b_unit = resolve_b_unit(data, b_unit)
+        data = iter_chunks(data, chunk_size)
+
+    columns = {key: [] for key in labels}
+    for chunk in data:
+        results = _evaluate_chunk(chunk, models, dtype, b_unit)
+        for key in labels[1:]:
+            stats[key].update(results[reference], results[key])
+        if return_values:
+            for key in labels:
+                columns[key].append(results[key])
+
+    values = None
+    if return_values:
+        values = pandas.DataFrame({key: numpy.concatenate(columns[key]) if columns[key]
+                                   else numpy.array([], dtype=dtype) for key in labels},
+                                  index=index)
+    stats = pandas.DataFrame([dict(version=key, **stats[key].result()) for key in labels[1:]],
+                             columns=['version', 'n', 'mean', 'rms', 'max_abs', 'nan_mismatch'])
+    return values, stats
@@ -13,3 +13,7 @@ except (ImportError, AttributeError):  # older importlib version
   from pkg_resources import resource_filename
   modelsdir = resource_filename('gdr3apcal', 'models')
   __PACKAGE_DIR__ = resource_filename('gdr3apcal', '')
+
+# compiled model artifacts (set GDR3APCAL_CACHE to relocate)
+cachedir = os.environ.get('GDR3APCAL_CACHE',
+                          os.path.join(os.path.expanduser('~'), '.cache', 'gdr3apcal'))
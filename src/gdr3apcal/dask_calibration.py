@@ -0,0 +1,107 @@
+""" Partition-wise calibration of dask DataFrames
+
+The calibration models work on in-memory pandas frames. For catalogues that
+do not fit in memory, we map the models over the partitions of a
+`dask.dataframe.DataFrame`. Each partition is calibrated independently (the
+library grouping is local to the partition), so no global shuffle is needed.
+
+The models are never shipped with the tasks: each task only carries the name
+of the model and of the configuration file. The worker process loads the
+model on first use and keeps it for all subsequent partitions.
+
+If cos(b) must be computed from b with an unknown unit, the unit is guessed
+once from the full column (an extra reduction over b), never per partition.
+
+dask is an optional dependency (``pip install gdr3apcal[dask]``).
+"""
+from typing import Any, Union
+import numpy
+import pandas
+# local code
+from .calibration_models import CalibrationModel
+from .partitions import get_collection
+
+
+__all__ = ['is_dask_dataframe', 'calibrate_partitions']
+
+
+def is_dask_dataframe(obj: Any) -> bool:
+    """ Check whether obj is a dask DataFrame without importing dask
+
+    dask 2024.3-2024.12 returns the collections of the separate `dask_expr`
+    package (e.g. `dask_expr._collection.DataFrame`).
+    """
+    return (type(obj).__module__.split('.')[0] in ('dask', 'dask_expr')) and hasattr(obj, 'map_partitions')
+
+
+def _output_frame(values: numpy.array, flags: numpy.array, index: pandas.Index,
+                  output_name: str, flags_name: str, dtype: type) -> pandas.DataFrame:
+    """ Calibrated values with their quality flags """
+    return pandas.DataFrame({output_name: pandas.Series(values, index=index, dtype=dtype),
+                             flags_name: pandas.Series(flags, index=index, dtype=numpy.uint8)})
+
+
+def _calibrate_partition(partition: pandas.DataFrame, name: str,
+                         configuration_file: str, output_name: str,
+                         b_unit: str = None, dtype: type = numpy.float64,
+                         flags_name: str = None) -> Union[pandas.Series, pandas.DataFrame]:
+    """ Apply a model to a single in-memory partition
+
+    With flags_name, returns a frame of the values and of their quality flags.
+    """
+    values = numpy.array([], dtype=dtype)
+    flags = numpy.array([], dtype=numpy.uint8)
+    if len(partition) > 0:
+        model = get_collection(configuration_file)[name]
+        # models may add columns (e.g. cosb), do not alter the partition in place.
+        result = model(partition.copy(deep=False), dtype=dtype,
+                       return_flags=bool(flags_name), b_unit=b_unit)
+        values, flags = result if flags_name else (result, None)
+    if flags_name:
+        return _output_frame(values, flags, partition.index, output_name, flags_name, dtype)
+    return pandas.Series(values, index=partition.index, dtype=dtype, name=output_name)
+
+
+def calibrate_partitions(ddf, name: str, configuration_file: str = None,
+                         output_name: str = None, b_unit: str = None,
+                         dtype: type = numpy.float64, return_flags: bool = False):
+    """ Lazily apply the calibration model `name` to a dask DataFrame
+
+    Parameters
+    ----------
+    ddf: dask.dataframe.DataFrame
+        input data with the GACS column names
+    name: str
+        name of the model in the configuration (e.g. 'mh')
+    configuration_file: str
+        configuration file used by the workers to load the model
+        (default is the package configuration)
+    output_name: str
+        name of the output series (default '{name}_calibrated')
+    b_unit: str
+        unit of b ('deg' or 'rad') if cos(b) is computed from it
+        (default: guessed once from the whole column)
+    dtype: type
+        precision of the features and of the evaluation
+    return_flags: bool
+        also return the quality flags, in a column '{name}_flags'
+
+    returns
+    -------
+    calibrated: dask.dataframe.Series or dask.dataframe.DataFrame
+        lazy series of calibrated values aligned with the input partitions
+        (a frame of the values and flags with return_flags)
+    """
+    if output_name is None:
+        output_name = name + '_calibrated'
+    if b_unit is None and 'cosb' not in ddf.columns and 'b' in ddf.columns:
+        b_max = ddf['b'].abs().max().compute()
+        b_unit = CalibrationModel.guess_b_unit(numpy.array([b_max]))
+    dtype = numpy.dtype(dtype)
+    flags_name = name + '_flags' if return_flags else None
+    if return_flags:
+        meta = _output_frame([], [], pandas.RangeIndex(0), output_name, flags_name, dtype)
+    else:
+        meta = pandas.Series([], dtype=dtype, name=output_name)
+    return ddf.map_partitions(_calibrate_partition, name, configuration_file, output_name,
+                              b_unit, dtype, flags_name, meta=meta)
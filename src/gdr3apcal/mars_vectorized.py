@@ -0,0 +1,279 @@
+""" Vectorized evaluation of the exported MARS models
+
+The MARS models are shipped as python source code (see
+:mod:`gdr3apcal.mars_converter`): one lambda per term, evaluated row by row.
+Each term is a coefficient times a product of smoothed hinge functions (the
+`pyearth` cubic smoothing between a lower and an upper knot)::
+
+    right: 0           if x <= lower, (x - knot) if x >= upper, p (x - lower)^2 + r (x - lower)^3
+    left:  -(x - knot) if x <= lower, 0          if x >= upper, p (x - upper)^2 + r (x - upper)^3
+
+This module parses that source into coefficient arrays once and evaluates
+all hinge functions as arrays (the "basis"), then all the terms at once.
+The evaluation can run in float32 to halve the memory traffic.
+"""
+import os
+import ast
+import hashlib
+import inspect
+import textwrap
+from typing import Callable, Sequence
+import numpy
+
+
+__all__ = ['VectorizedMarsFunction', 'compile_models', 'save_models', 'load_models']
+
+
+def _literal(node: ast.AST) -> float:
+    """ Value of a numerical constant node (including negative numbers) """
+    value = ast.literal_eval(node)
+    if not isinstance(value, (int, float)):
+        raise ValueError(f"Expecting a number, got {ast.dump(node)}")
+    return float(value)
+
+
+def _feature_index(node: ast.AST) -> int:
+    """ index i from an `x[i]` node """
+    if not (isinstance(node, ast.Subscript) and isinstance(node.value, ast.Name)):
+        raise ValueError(f"Expecting x[i], got {ast.dump(node)}")
+    return int(ast.literal_eval(node.slice))
+
+
+def _flatten_product(node: ast.AST) -> list:
+    """ operands of a chain of multiplications """
+    if isinstance(node, ast.BinOp) and isinstance(node.op, ast.Mult):
+        return _flatten_product(node.left) + _flatten_product(node.right)
+    return [node]
+
+
+def _parse_cubic(node: ast.AST) -> tuple:
+    """ (p, r, anchor) from `p * (x[i] - anchor) ** 2 + r * (x[i] - anchor) ** 3` """
+    if not (isinstance(node, ast.BinOp) and isinstance(node.op, ast.Add)):
+        raise ValueError(f"Expecting a cubic polynomial, got {ast.dump(node)}")
+    p_term, r_term = node.left, node.right
+    p = _literal(p_term.left)
+    r = _literal(r_term.left)
+    anchor = _literal(p_term.right.left.right)
+    return p, r, anchor
+
+
+def _parse_hinge(node: ast.AST) -> tuple:
+    """ (feature, direction, lower, knot, upper, p, r) of a smoothed hinge function
+
+    direction is +1 for the right hinges and -1 for the left ones.
+    """
+    if not (isinstance(node, ast.IfExp) and isinstance(node.orelse, ast.IfExp)):
+        raise ValueError(f"Expecting a smoothed hinge function, got {ast.dump(node)}")
+    feature = _feature_index(node.test.left)
+    lower = _literal(node.test.comparators[0])
+    upper = _literal(node.orelse.test.comparators[0])
+    p, r, _ = _parse_cubic(node.orelse.orelse)
+    if isinstance(node.body, ast.UnaryOp):    # -(x - knot) if x <= lower else 0 ...
+        direction = -1
+        knot = _literal(node.body.operand.right)
+    else:                                     # 0 if x <= lower else (x - knot) ...
+        direction = 1
+        knot = _literal(node.orelse.body.right)
+    return feature, direction, lower, knot, upper, p, r
+
+
+def _is_null_function(fdef: ast.FunctionDef) -> bool:
+    """ Detect the models that only yield NaN (uncalibrated libraries) """
+    for node in ast.walk(fdef):
+        if isinstance(node, ast.Yield):
+            try:
+                return numpy.isnan(float(ast.literal_eval(node.value.args[0])))
+            except (AttributeError, IndexError, ValueError, TypeError):
+                return False
+    return False
+
+
+class VectorizedMarsFunction:
+    """ Array representation of a MARS model
+
+    Attributes
+    ----------
+    intercept: float
+        constant term (NaN for an uncalibrated model)
+    coefficients: numpy.array
+        coefficient of each term (n_terms,)
+    terms: numpy.array
+        hinge indices of each term (n_terms, max_degree), padded with n_hinges
+    feature, direction, lower, knot, upper, p, r: numpy.array
+        parameters of the unique hinge functions (n_hinges,)
+    """
+    _hinge_fields = ('feature', 'direction', 'lower', 'knot', 'upper', 'p', 'r')
+
+    def __init__(self, intercept: float, coefficients: Sequence[float],
+                 terms: Sequence[Sequence[int]], hinges: Sequence[tuple],
+                 chunk_size: int = 65536):
+        """ Constructor """
+        self.intercept = float(intercept)
+        self.coefficients = numpy.asarray(coefficients, dtype=numpy.float64)
+        hinges = list(hinges)
+        params = numpy.array(hinges, dtype=numpy.float64).reshape(-1, len(self._hinge_fields))
+        for k, field in enumerate(self._hinge_fields):
+            setattr(self, field, params[:, k])
+        self.feature = self.feature.astype(numpy.intp)
+        self.direction = self.direction.astype(numpy.int8)
+        n_hinges = len(hinges)
+        max_degree = max([len(t) for t in terms] + [1])
+        self.terms = numpy.full((len(terms), max_degree), n_hinges, dtype=numpy.intp)
+        for k, term in enumerate(terms):
+            self.terms[k, :len(term)] = term
+        self.chunk_size = chunk_size
+
+    @property
+    def calibrated(self) -> bool:
+        """ False for the models of uncalibrated libraries (always NaN) """
+        return bool(numpy.isfinite(self.intercept))
+
+    @classmethod
+    def from_source(cls, source: str) -> 'VectorizedMarsFunction':
+        """ Parse the source code of an exported model function """
+        fdef = ast.parse(textwrap.dedent(source)).body[0]
+        if _is_null_function(fdef):
+            return cls(float('nan'), [], [], [])
+
+        accessors = None
+        for node in fdef.body:
+            if isinstance(node, ast.Assign) and node.targets[0].id == 'accessors':
+                accessors = node.value.elts
+        if accessors is None:
+            raise ValueError(f"{fdef.name} is not an exported MARS model.")
+
+        intercept = 0.
+        coefficients, terms, hinges = [], [], {}
+        for accessor in accessors:
+            operands = _flatten_product(accessor.body)
+            coefficient = _literal(operands[0])
+            if len(operands) == 1:
+                intercept += coefficient
+                continue
+            term = []
+            for operand in operands[1:]:
+                hinge = _parse_hinge(operand)
+                term.append(hinges.setdefault(hinge, len(hinges)))
+            coefficients.append(coefficient)
+            terms.append(term)
+        return cls(intercept, coefficients, terms, list(hinges))
+
+    @classmethod
+    def from_function(cls, fn: Callable) -> 'VectorizedMarsFunction':
+        """ Parse an exported model function (e.g. `gdr3apcal.models.mars_mh.mh_phoenix`) """
+        try:
+            source = inspect.getsource(fn)
+        except (OSError, TypeError) as e:
+            raise ValueError(f"Cannot access the source of {fn!r}") from e
+        return cls.from_source(source)
+
+    def to_arrays(self) -> dict:
+        """ Model parameters as a dictionary of arrays (see :meth:`from_arrays`) """
+        arrays = {'intercept': numpy.array(self.intercept),
+                  'coefficients': self.coefficients,
+                  'terms': self.terms}
+        for field in self._hinge_fields:
+            arrays[field] = getattr(self, field)
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays: dict, chunk_size: int = 65536) -> 'VectorizedMarsFunction':
+        """ Rebuild a model from :meth:`to_arrays` (e.g. loaded from a cached artifact) """
+        obj = cls.__new__(cls)
+        obj.intercept = float(arrays['intercept'])
+        obj.coefficients = numpy.asarray(arrays['coefficients'], dtype=numpy.float64)
+        obj.terms = numpy.asarray(arrays['terms'], dtype=numpy.intp)
+        for field in cls._hinge_fields:
+            setattr(obj, field, numpy.asarray(arrays[field], dtype=numpy.float64))
+        obj.feature = obj.feature.astype(numpy.intp)
+        obj.direction = obj.direction.astype(numpy.int8)
+        obj.chunk_size = chunk_size
+        return obj
+
+    def checksum(self) -> str:
+        """ sha256 of the model parameters (independent of the source formatting) """
+        hashinst = hashlib.sha256()
+        hashinst.update(numpy.float64(self.intercept).tobytes())
+        for array in [self.coefficients, self.terms] + [getattr(self, field) for field in self._hinge_fields]:
+            hashinst.update(numpy.ascontiguousarray(array, dtype='<f8').tobytes())
+        return hashinst.hexdigest()
+
+    def domain(self) -> dict:
+        """ Outer knots of each feature index used by the model: {index: (min, max)} """
+        return {int(k): (float(self.lower[self.feature == k].min()),
+                         float(self.upper[self.feature == k].max()))
+                for k in numpy.unique(self.feature)}
+
+    def basis(self, X: numpy.array, dtype: type = None) -> numpy.array:
+        """ Values of all hinge functions (n_samples, n_hinges + 1)
+
+        The last column is 1 and pads the terms of lower degree.
+        """
+        dtype = X.dtype if dtype is None else numpy.dtype(dtype)
+        x = numpy.asarray(X[:, self.feature], dtype=dtype)
+        lower = self.lower.astype(dtype)
+        upper = self.upper.astype(dtype)
+        right = self.direction > 0
+        # below lower knot: 0 (right) or knot - x (left); above upper: x - knot (right) or 0 (left)
+        linear = x - self.knot.astype(dtype)
+        below = numpy.where(right, dtype.type(0), -linear)
+        above = numpy.where(right, linear, dtype.type(0))
+        delta = x - numpy.where(right, lower, upper)
+        cubic = delta * delta * (self.p.astype(dtype) + self.r.astype(dtype) * delta)
+        values = numpy.where(x <= lower, below, numpy.where(x >= upper, above, cubic))
+        return numpy.hstack([values, numpy.ones((len(x), 1), dtype=dtype)])
+
+    def __call__(self, X: numpy.array, dtype: type = None) -> numpy.array:
+        """ Evaluate the model on the feature matrix X (n_samples, n_features) """
+        dtype = numpy.asarray(X).dtype if dtype is None else numpy.dtype(dtype)
+        result = numpy.empty(len(X), dtype=dtype)
+        if not self.calibrated:
+            result.fill(numpy.nan)
+            return result
+        coefficients = self.coefficients.astype(dtype)
+        # chunks keep the basis arrays small
+        for start in range(0, len(X), self.chunk_size):
+            B = self.basis(X[start: start + self.chunk_size], dtype)
+            T = B[:, self.terms[:, 0]]
+            for k in range(1, self.terms.shape[1]):
+                T *= B[:, self.terms[:, k]]
+            result[start: start + len(B)] = T @ coefficients + dtype.type(self.intercept)
+        return result
+
+    def __repr__(self) -> str:
+        """ How it shows on the command line """
+        return "VectorizedMarsFunction({0:d} terms, {1:d} hinges)".format(len(self.coefficients), len(self.feature))
+
+
+def compile_models(models: dict) -> dict:
+    """ Parse the exported model functions, keeping the callables that are not MARS models """
+    compiled = {}
+    for name, fn in models.items():
+        try:
+            compiled[name] = VectorizedMarsFunction.from_function(fn)
+        except ValueError:
+            compiled[name] = fn
+    return compiled
+
+
+def save_models(fname: str, models: dict):
+    """ Store compiled models in a single `.npz` artifact (written atomically) """
+    arrays = {'__names__': numpy.array(list(models))}
+    for name, model in models.items():
+        for field, array in model.to_arrays().items():
+            arrays[f'{name}.{field}'] = array
+    os.makedirs(os.path.dirname(fname), exist_ok=True)
+    tmpname = f'{fname}.{os.getpid():d}.tmp.npz'
+    numpy.savez(tmpname, **arrays)
+    os.replace(tmpname, fname)
+
+
+def load_models(fname: str) -> dict:
+    """ Load the compiled models of an artifact written by :func:`save_models` """
+    with numpy.load(fname, allow_pickle=False) as data:
+        models = {}
+        for name in data['__names__']:
+            prefix = f'{name}.'
+            arrays = {key[len(prefix):]: data[key] for key in data.files if key.startswith(prefix)}
+            models[str(name)] = VectorizedMarsFunction.from_arrays(arrays)
+    return models
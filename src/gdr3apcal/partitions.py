@@ -0,0 +1,130 @@
+""" Helpers shared by the partition-wise and chunked calibration paths
+
+The dask integration, the runner, the multiprocessing helpers, the release
+comparison and the aggregation all calibrate data piece by piece, often in
+worker processes. They share a per-process cache of the calibration
+collections, so that each process loads the models only once, and the way
+partitions and chunks are read.
+
+The unit of the Galactic latitude b (when cos(b) is computed from it) is
+guessed from the data. Such a guess is only valid on the full data set: it
+is made once before splitting the data (:func:`resolve_b_unit`), and chunks
+without a known unit are rejected (:func:`check_b_unit`).
+
+A partition is a file name, an in-memory frame, or a :class:`SourceIdRange`
+of files, which is only read (and filtered) by the process calibrating it.
+"""
+import threading
+from typing import Iterator, Sequence, Union
+import pandas
+# local code
+from .calibration_models import CalibrationModel
+
+
+__all__ = ['get_collection', 'SourceIdRange', 'read_partition', 'iter_chunks',
+           'resolve_b_unit', 'check_b_unit']
+
+
+# per-process cache of calibration collections (one per configuration file)
+_collections = {}
+_collections_lock = threading.Lock()
+
+
+def get_collection(configuration_file: str = None):
+    """ Get the calibration collection of this process (loaded only once) """
+    with _collections_lock:
+        if configuration_file not in _collections:
+            # local import to avoid circular dependencies
+            from .calibration import GaiaDR3_GSPPhot_cal
+            _collections[configuration_file] = GaiaDR3_GSPPhot_cal(configuration_file)
+        return _collections[configuration_file]
+
+
+class SourceIdRange:
+    """ Lazy partition: the rows of some files with start <= source_id < stop
+
+    Only the file names and the range are sent to the worker processes, which
+    read the files and keep the rows of the range (parquet files are filtered
+    while reading, csv files chunk by chunk).
+
+    Parameters
+    ----------
+    files: Sequence[str]
+        csv or parquet files containing rows of the range
+    start: int
+        first source_id of the range
+    stop: int
+        end of the range (excluded)
+    column: str
+        column of the source_id
+    chunk_size: int
+        rows read at once from csv files
+    """
+
+    def __init__(self, files: Sequence[str], start: int, stop: int,
+                 column: str = 'source_id', chunk_size: int = 1_000_000):
+        """ Constructor """
+        self.files = tuple(files)
+        self.start = int(start)
+        self.stop = int(stop)
+        self.column = column
+        self.chunk_size = chunk_size
+
+    def _select(self, df: pandas.DataFrame) -> pandas.DataFrame:
+        """ Rows of the range """
+        values = df[self.column].values
+        return df[(values >= self.start) & (values < self.stop)]
+
+    def read(self) -> pandas.DataFrame:
+        """ Read the rows of the range from all the files """
+        parts = []
+        for fname in self.files:
+            if fname.endswith('.parquet'):
+                parts.append(self._select(pandas.read_parquet(
+                    fname, filters=[(self.column, '>=', self.start), (self.column, '<', self.stop)])))
+            else:
+                parts.extend(self._select(chunk)
+                             for chunk in pandas.read_csv(fname, chunksize=self.chunk_size))
+        return pandas.concat(parts, ignore_index=True)
+
+    def __repr__(self) -> str:
+        """ How it shows on the command line """
+        return "SourceIdRange({0:d} <= {1:s} < {2:d}, {3:d} files)".format(
+            self.start, self.column, self.stop, len(self.files))
+
+
+def read_partition(source: Union[str, pandas.DataFrame, SourceIdRange]) -> pandas.DataFrame:
+    """ Read the data of a partition (file name, in-memory frame or source_id range) """
+    if isinstance(source, pandas.DataFrame):
+        return source
+    if isinstance(source, SourceIdRange):
+        return source.read()
+    if source.endswith('.parquet'):
+        return pandas.read_parquet(source)
+    return pandas.read_csv(source)
+
+
+def iter_chunks(df: pandas.DataFrame, chunk_size: int) -> Iterator[pandas.DataFrame]:
+    """ Consecutive rows of a DataFrame (views, so that added columns do not reach the input) """
+    for start in range(0, len(df), chunk_size):
+        yield df.iloc[start: start + chunk_size].copy(deep=False)
+
+
+def _needs_b(columns) -> bool:
+    """ Whether cos(b) has to be computed from b """
+    return ('cosb' not in columns) and ('b' in columns)
+
+
+def resolve_b_unit(df: pandas.DataFrame, b_unit: str = None) -> str:
+    """ Unit of b decided once on the full data, before splitting it into chunks """
+    if b_unit is None and _needs_b(df.columns):
+        return CalibrationModel.guess_b_unit(df['b'].values)
+    return b_unit
+
+
+def check_b_unit(df: pandas.DataFrame, b_unit: str = None) -> str:
+    """ Unit of b of a chunk, which cannot be guessed from the chunk alone """
+    if b_unit is None and _needs_b(df.columns):
+        raise ValueError("The unit of b cannot be guessed chunk by chunk. "
+                         "Provide b_unit ('deg' or 'rad') or a cosb column.")
+    return b_unit
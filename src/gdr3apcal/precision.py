@@ -0,0 +1,123 @@
+""" Accuracy of the reduced-precision (float32) evaluation
+
+GSP-Phot parameters carry about 4-5 significant digits, so single precision
+is in principle sufficient. However, the MARS terms include cubic functions of
+features with large values (e.g. Teff around 4000-8000 K), where float32
+rounding is amplified. This harness samples the training domain of each
+library model (the `training_domain` of the configuration, and the range
+spanned by the outer knots for the other features) and reports the deviation
+of the float32 calibration from the float64 one in bins of Teff.
+
+.. code-block:: python
+
+    from gdr3apcal.precision import float32_deviation_report
+    print(float32_deviation_report())
+"""
+from typing import Sequence
+import numpy
+import pandas
+# local code
+from .calibration_models import VectorizedMarsModel
+
+
+__all__ = ['float32_deviation_report']
+
+
+def _domain(models: Sequence[VectorizedMarsModel], features: Sequence[str]) -> dict:
+    """ Range of each feature index: configured training domain, or outer knots of the models """
+    ranges = {}
+    for model in models:
+        for index, (vmin, vmax) in model.model.domain().items():
+            previous = ranges.get(index, (vmin, vmax))
+            ranges[index] = (min(vmin, previous[0]), max(vmax, previous[1]))
+        for name, (vmin, vmax) in getattr(model, 'domain', {}).items():
+            if name in features:
+                ranges[features.index(name)] = (vmin, vmax)
+    return ranges
+
+
+def _sample_domain(models: Sequence[VectorizedMarsModel], features: Sequence[str],
+                   n_samples: int, rng: numpy.random.Generator) -> numpy.array:
+    """ Uniform samples within the training domain of the models
+
+    Features of the configured `training_domain` are sampled over that range,
+    the others within the outer knots of the models. Features not used by any
+    of the models are set to 0 (they do not change the values).
+    """
+    ranges = _domain(models, features)
+    X = numpy.zeros((n_samples, len(features)))
+    for index, (vmin, vmax) in ranges.items():
+        X[:, index] = rng.uniform(vmin, vmax, n_samples)
+    return X
+
+
+def float32_deviation_report(name: str = 'mh',
+                             n_samples: int = 200_000,
+                             teff_bins: Sequence[float] = None,
+                             tolerance: float = 1e-4,
+                             seed: int = 0,
+                             configuration_file: str = None) -> pandas.DataFrame:
+    """ Deviations of the float32 calibration from float64 per library and Teff bin
+
+    Parameters
+    ----------
+    name: str
+        grouped model to test (default 'mh')
+    n_samples: int
+        number of random samples per library
+    teff_bins: Sequence[float]
+        Teff bin edges (default: 250 K bins over the training domain,
+        i.e. the configured `training_domain` of Teff when given)
+    tolerance: float
+        maximum absolute deviation for float32 to be considered safe
+        (default 1e-4, below the precision of the GSP-Phot values)
+    seed: int
+        seed of the random samples
+    configuration_file: str
+        configuration of the models (default is the package configuration)
+
+    returns
+    -------
+    report: pandas.DataFrame
+        one row per library and Teff bin with the number of samples, the
+        maximum and 99th percentile of the absolute deviations, and whether
+        the maximum deviation is below the tolerance.
+    """
+    # local import to avoid circular dependencies
+    from .calibration import GaiaDR3_GSPPhot_cal
+    grouped = GaiaDR3_GSPPhot_cal(configuration_file)[name]
+    models = {key: model for key, model in grouped.model.items()
+              if isinstance(model, VectorizedMarsModel) and model.model.calibrated}
+    features = grouped.features
+    teff_index = features.index('teff_gspphot')
+    label_index = features.index(grouped.label)
+
+    rng = numpy.random.default_rng(seed)
+    rows = []
+    for key, model in models.items():
+        X = _sample_domain([model], features, n_samples, rng)
+        values = X[:, label_index]
+        reference = model.evaluate(X, values)
+        single = model.evaluate(X.astype(numpy.float32), values.astype(numpy.float32))
+        deviation = numpy.abs(single.astype(numpy.float64) - reference)
+
+        teff = X[:, teff_index]
+        if teff_bins is None:
+            tmin, tmax = _domain([model], features)[teff_index]
+            inner = numpy.arange(numpy.floor(tmin / 250) * 250 + 250, tmax, 250)
+            edges = numpy.concatenate([[tmin], inner, [tmax]])
+        else:
+            edges = numpy.asarray(teff_bins)
+        which = numpy.digitize(teff, edges) - 1
+        for k in range(len(edges) - 1):
+            dev = deviation[which == k]
+            if not len(dev):
+                continue
+            rows.append({'model': key,
+                         'teff_min': edges[k], 'teff_max': edges[k + 1],
+                         'n': len(dev),
+                         'max_abs_deviation': dev.max(),
+                         'p99_abs_deviation': numpy.percentile(dev, 99),
+                         'safe': bool(dev.max() < tolerance)})
+    return pandas.DataFrame(rows, columns=['model', 'teff_min', 'teff_max', 'n',
+                                           'max_abs_deviation', 'p99_abs_deviation', 'safe'])
@@ -0,0 +1,341 @@
+""" Checkpointed full-catalogue calibration
+
+A full recalibration of the GSP-Phot catalogue takes hours. The runner splits
+the input into partitions (input files or HEALPix ranges of the Gaia
+`source_id`, read lazily by the workers), calibrates them over a local process pool, and writes one output
+file per partition. Every completed partition is recorded in a manifest
+together with the model version and checksum, so that an interrupted run only
+recomputes the unfinished partitions.
+
+The manifest also records the version and checksum of each sub-model (e.g.
+per GSP-Phot library). After a new model release, completed partitions are
+updated in place: only the rows whose sub-model changed are recomputed.
+
+Example
+-------
+
+.. code-block:: python
+
+    from gdr3apcal.runner import CalibrationRunner, partition_by_file
+
+    runner = CalibrationRunner('calibrated/', n_workers=8)
+    stats = runner.run(partition_by_file(glob.glob('gspphot/*.csv')))
+"""
+import os
+import json
+import time
+import hashlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Sequence, Union, Tuple
+import numpy
+import pandas
+# local code
+from .partitions import get_collection, read_partition, check_b_unit, SourceIdRange
+
+
+__all__ = ['CalibrationRunner', 'healpix_from_source_id',
+           'partition_by_file', 'partition_by_healpix']
+
+
+# The Gaia source_id encodes the HEALPix level-12 nested index
+# in its highest bits: healpix_12 = source_id // 2^35
+SOURCE_ID_HEALPIX_FACTOR = 2 ** 35
+HEALPIX_MAX_LEVEL = 12
+
+
+def healpix_from_source_id(source_id: Union[int, numpy.array], level: int = 12) -> numpy.array:
+    """ HEALPix nested index at a given level (0-12) from the Gaia source_id """
+    if not 0 <= level <= HEALPIX_MAX_LEVEL:
+        raise ValueError(f"HEALPix level must be within 0..{HEALPIX_MAX_LEVEL:d}, got {level}")
+    factor = SOURCE_ID_HEALPIX_FACTOR * 4 ** (HEALPIX_MAX_LEVEL - level)
+    return numpy.asarray(source_id, dtype=numpy.int64) // factor
+
+
+def partition_by_file(files: Sequence[str]) -> dict:
+    """ One partition per input file, keyed by the file name without extension """
+    partitions = {}
+    for fname in sorted(files):
+        key = os.path.splitext(os.path.basename(fname))[0]
+        if key in partitions:
+            raise ValueError(f"Duplicated partition name {key:s} ({fname:s})")
+        partitions[key] = fname
+    return partitions
+
+
+def _read_source_id(fname: str, source_id: str) -> numpy.array:
+    """ Only the source_id column of a file """
+    if fname.endswith('.parquet'):
+        return pandas.read_parquet(fname, columns=[source_id])[source_id].values
+    return pandas.read_csv(fname, usecols=[source_id])[source_id].values
+
+
+def partition_by_healpix(data: Union[pandas.DataFrame, Sequence[str]], level: int = 3,
+                         source_id: str = 'source_id') -> dict:
+    """ Split the data into HEALPix ranges of the source_id
+
+    Each partition is a HEALPix pixel at the given level, i.e. a contiguous
+    range of source_id values, keyed as 'hpx{level}-{pixel}'.
+
+    With files, the partitions are lazy :class:`gdr3apcal.partitions.SourceIdRange`:
+    only the source_id column is read here, and each worker reads the rows of
+    its pixel from the files containing it. Each file is read once per pixel
+    it contains, so choose a level with pixels not much smaller than the files.
+    A DataFrame is split in memory, which is only a convenience for small data.
+    The Gaia bulk files already cover HEALPix ranges: full runs on them are
+    best partitioned with :func:`partition_by_file`.
+    """
+    if isinstance(data, pandas.DataFrame):
+        pixels = healpix_from_source_id(data[source_id].values, level)
+        return {f'hpx{level:d}-{pixel:06d}': data.iloc[indices]
+                for pixel, indices in pandas.Series(pixels).groupby(pixels).indices.items()}
+
+    files = {}
+    for fname in sorted(data):
+        for pixel in numpy.unique(healpix_from_source_id(_read_source_id(fname, source_id), level)):
+            files.setdefault(int(pixel), []).append(fname)
+    factor = SOURCE_ID_HEALPIX_FACTOR * 4 ** (HEALPIX_MAX_LEVEL - level)
+    return {f'hpx{level:d}-{pixel:06d}': SourceIdRange(files[pixel], pixel * factor, (pixel + 1) * factor,
+                                                       source_id)
+            for pixel in sorted(files)}
+
+
+def _write_partition(df: pandas.DataFrame, fname: str):
+    """ Atomically write a partition output (format from the extension) """
+    tmpname = fname + '.tmp'
+    if fname.endswith('.parquet'):
+        df.to_parquet(tmpname, index=False)
+    else:
+        df.to_csv(tmpname, index=False)
+    os.replace(tmpname, fname)
+
+
+def _checksum(fname: str) -> str:
+    """ sha256 of a file """
+    hashinst = hashlib.sha256()
+    with open(fname, 'rb') as fin:
+        for chunk in iter(lambda: fin.read(hashinst.block_size * 128), b''):
+            hashinst.update(chunk)
+    return hashinst.hexdigest()
+
+
+def _calibrate_partition_file(key: str, source: Union[str, pandas.DataFrame, SourceIdRange],
+                              name: str, configuration_file: str,
+                              output: str, output_column: str,
+                              keep_columns: Sequence[str], b_unit: str = None) -> Tuple:
+    """ Calibrate a single partition and write its output (runs in a worker) """
+    start = time.perf_counter()
+    df = read_partition(source)
+    b_unit = check_b_unit(df, b_unit)
+    model = get_collection(configuration_file)[name]
+    values = model(df.copy(deep=False), b_unit=b_unit)
+
+    result = pandas.DataFrame({k: df[k].values for k in keep_columns if k in df.columns})
+    groupby = getattr(model, 'groupby', None)
+    if groupby in result.columns:
+        # compact library column (dictionary-encoded in parquet)
+        result[groupby] = model.encode_libraries(result[groupby])
+    result[output_column] = values
+    _write_partition(result, output)
+    return key, len(df), time.perf_counter() - start, _checksum(output)
+
+
+def _update_partition_file(key: str, source: Union[str, pandas.DataFrame, SourceIdRange],
+                           name: str, configuration_file: str,
+                           output: str, output_column: str,
+                           previous_versions: dict, b_unit: str = None) -> Tuple:
+    """ Recompute the rows of changed sub-models in an existing output (runs in a worker) """
+    start = time.perf_counter()
+    df = read_partition(source)
+    b_unit = check_b_unit(df, b_unit)
+    result = read_partition(output)
+    if len(result) != len(df):
+        raise RuntimeError(f"Output of partition {key:s} does not match its input.")
+    data = df.copy(deep=False)
+    data[output_column] = result[output_column].values
+    updated = get_collection(configuration_file).updateCalibration(
+        data, previous_versions, name, output_column, b_unit)
+    if updated.any():
+        result[output_column] = data[output_column].values
+        _write_partition(result, output)
+    return key, int(updated.sum()), time.perf_counter() - start, _checksum(output)
+
+
+class CalibrationRunner:
+    """ Partitioned, resumable calibration of a full catalogue
+
+    Parameters
+    ----------
+    output_dir: str
+        where the partition outputs and the manifest are written
+    name: str
+        model to apply (default 'mh')
+    configuration_file: str
+        configuration of the models (default is the package configuration)
+    n_workers: int
+        number of processes (default: number of cpus).
+        `n_workers <= 1` runs in the current process.
+    output_format: str
+        'csv' or 'parquet'
+    keep_columns: Sequence[str]
+        input columns copied to the outputs when available
+    b_unit: str
+        unit of b ('deg' or 'rad'), required if cos(b) is computed from it
+        (it cannot be guessed partition by partition)
+    """
+    manifest_name = 'manifest.json'
+
+    def __init__(self, output_dir: str, name: str = 'mh',
+                 configuration_file: str = None,
+                 n_workers: int = None,
+                 output_format: str = 'csv',
+                 keep_columns: Sequence[str] = ('source_id', 'libname_gspphot'),
+                 b_unit: str = None):
+        """ Constructor """
+        # local import to avoid circular dependencies
+        from .calibration import _read_configuration
+        if output_format not in ('csv', 'parquet'):
+            raise ValueError(f"Unsupported output format {output_format}")
+        self.output_dir = output_dir
+        self.name = name
+        self.configuration_file = configuration_file
+        self.n_workers = os.cpu_count() if n_workers is None else n_workers
+        self.output_format = output_format
+        self.keep_columns = list(keep_columns)
+        self.b_unit = b_unit
+        self.output_column = name + '_calibrated'
+        model_config = _read_configuration(configuration_file)[name]
+        self.model_info = {'name': name,
+                           'version': str(model_config['version']),
+                           'md5sum': model_config['md5sum']}
+        self.submodels = get_collection(configuration_file).subModelVersions(name)
+
+    @property
+    def manifest_file(self) -> str:
+        """ location of the manifest """
+        return os.path.join(self.output_dir, self.manifest_name)
+
+    def output_file(self, key: str) -> str:
+        """ output file of a given partition """
+        return os.path.join(self.output_dir, f'part-{key:s}.{self.output_format:s}')
+
+    def read_manifest(self) -> dict:
+        """ Read the manifest or start a new one
+
+        Partitions produced by another model keep their record: they are
+        updated for the sub-models that changed (see :meth:`status`).
+        """
+        manifest = {'model': self.model_info, 'partitions': {}}
+        if not os.path.exists(self.manifest_file):
+            return manifest
+        with open(self.manifest_file, 'r', encoding='utf8') as fin:
+            previous = json.load(fin)
+        if previous.get('model', {}).get('name') != self.name:
+            print("Manifest of another model: all partitions will be recomputed.")
+            return manifest
+        if previous.get('model') != self.model_info:
+            print("Model changed since the previous run: partitions will be updated.")
+        manifest['partitions'] = previous.get('partitions', {})
+        return manifest
+
+    def _write_manifest(self, manifest: dict):
+        """ Atomically update the manifest """
+        tmpname = self.manifest_file + '.tmp'
+        with open(tmpname, 'w', encoding='utf8') as fout:
+            json.dump(manifest, fout, indent=1, sort_keys=True)
+        os.replace(tmpname, self.manifest_file)
+
+    def status(self, manifest: dict, key: str) -> str:
+        """ State of a partition
+
+        'complete': recorded with intact output and the current sub-models
+        'outdated': recorded with intact output, but some sub-models changed
+        'todo': anything else
+        """
+        record = manifest['partitions'].get(key)
+        if record is None:
+            return 'todo'
+        output = self.output_file(key)
+        if not (os.path.exists(output) and (_checksum(output) == record['sha256'])):
+            return 'todo'
+        if 'submodels' not in record:
+            return 'todo'
+        return 'complete' if record['submodels'] == self.submodels else 'outdated'
+
+    def is_complete(self, manifest: dict, key: str) -> bool:
+        """ Check a partition is recorded, intact and produced by the current sub-models """
+        return self.status(manifest, key) == 'complete'
+
+    def run(self, partitions: dict) -> pandas.DataFrame:
+        """ Calibrate all unfinished partitions
+
+        Parameters
+        ----------
+        partitions: dict
+            partition name -> file name, pandas.DataFrame or
+            :class:`gdr3apcal.partitions.SourceIdRange`
+            (see :func:`partition_by_file` and :func:`partition_by_healpix`)
+
+        returns
+        -------
+        stats: pandas.DataFrame
+            mode ('full' or 'update'), rows computed, duration and throughput
+            of the partitions processed in this run
+        """
+        os.makedirs(self.output_dir, exist_ok=True)
+        manifest = self.read_manifest()
+        status = {key: self.status(manifest, key) for key in partitions}
+        n_todo = sum(s == 'todo' for s in status.values())
+        n_outdated = sum(s == 'outdated' for s in status.values())
+        print(f"{len(partitions) - n_todo - n_outdated:d} partitions already completed, "
+              f"{n_outdated:d} to update, {n_todo:d} to go.")
+
+        tasks = {}
+        for key, state in status.items():
+            if state == 'todo':
+                tasks[key] = (_calibrate_partition_file,
+                              (key, partitions[key], self.name, self.configuration_file,
+                               self.output_file(key), self.output_column, self.keep_columns,
+                               self.b_unit))
+            elif state == 'outdated':
+                tasks[key] = (_update_partition_file,
+                              (key, partitions[key], self.name, self.configuration_file,
+                               self.output_file(key), self.output_column,
+                               manifest['partitions'][key]['submodels'], self.b_unit))
+        stats = []
+        failed = {}
+
+        def record(key, rows, seconds, sha256):
+            rate = rows / seconds if seconds > 0 else float('inf')
+            mode = 'update' if status[key] == 'outdated' else 'full'
+            print(f"{key:s} ({mode:s}): {rows:d} rows in {seconds:.2f} s ({rate:.0f} rows/s)")
+            previous = manifest['partitions'].get(key, {})
+            manifest['partitions'][key] = {'file': os.path.basename(self.output_file(key)),
+                                           'rows': previous.get('rows', rows) if mode == 'update' else rows,
+                                           'seconds': seconds,
+                                           'sha256': sha256,
+                                           'submodels': self.submodels}
+            manifest['model'] = self.model_info
+            self._write_manifest(manifest)
+            stats.append({'partition': key, 'mode': mode, 'rows': rows, 'seconds': seconds,
+                          'rows_per_second': rate})
+
+        if self.n_workers <= 1:
+            for key, (function, args) in tasks.items():
+                try:
+                    record(*function(*args))
+                except Exception as e:
+                    failed[key] = e
+        else:
+            with ProcessPoolExecutor(max_workers=self.n_workers) as pool:
+                futures = {pool.submit(function, *args): key
+                           for key, (function, args) in tasks.items()}
+                for future in as_completed(futures):
+                    try:
+                        record(*future.result())
+                    except Exception as e:
+                        failed[futures[future]] = e
+
+        if failed:
+            raise RuntimeError("Calibration failed for partitions: " +
+                               ', '.join(f'{k} ({v!r})' for k, v in failed.items()))
+        return pandas.DataFrame(stats, columns=['partition', 'mode', 'rows', 'seconds', 'rows_per_second'])
@@ -0,0 +1,270 @@
+""" Local micro-batching calibration service
+
+Interactive tools often send many small requests (a few to a few hundred
+sources). Each direct call pays the fixed cost of the model lookup, the
+DataFrame construction and the library grouping. The service keeps the models
+loaded and coalesces concurrent requests into a single vectorized batch, as
+long as the oldest request has not waited more than a configurable deadline.
+
+The server speaks newline-delimited JSON over a Unix socket or a local TCP
+port (standard library only)::
+
+    request:  {"data": {"teff_gspphot": [...], ..., "libname_gspphot": [...]}}
+    response: {"values": [...]}          (NaN values are returned as null)
+
+    request:  {"stats": true}
+    response: {"stats": {"requests": ..., "latency_p50": ..., ...}}
+
+Start a server with ``python -m gdr3apcal.service --unix /tmp/gdr3apcal.sock``.
+"""
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+import argparse
+from collections import deque
+from typing import Union
+import numpy
+import pandas
+# local code
+from .calibration_models import CalibrationModel
+from .partitions import resolve_b_unit
+
+
+__all__ = ['CalibrationService', 'request_calibration']
+
+
+class CalibrationService:
+    """ Asynchronous batching front-end to a calibration model
+
+    Parameters
+    ----------
+    name: str
+        model to apply (default 'mh')
+    configuration_file: str
+        configuration of the models (default is the package configuration)
+    max_latency: float
+        maximum time in seconds a request waits for other requests to join its batch
+    max_batch_size: int
+        maximum number of rows in a batch (a single larger request is not split)
+    history: int
+        number of latest requests kept for the latency statistics
+    b_unit: str
+        unit of b ('deg' or 'rad') if cos(b) is computed from it
+        (default: guessed per request, never across a batch)
+    """
+
+    def __init__(self, name: str = 'mh', configuration_file: str = None,
+                 max_latency: float = 0.005, max_batch_size: int = 100_000,
+                 history: int = 10_000, b_unit: str = None):
+        """ Constructor """
+        # local import to avoid circular dependencies
+        from .calibration import GaiaDR3_GSPPhot_cal
+        self.name = name
+        self.max_latency = max_latency
+        self.max_batch_size = max_batch_size
+        self.b_unit = b_unit
+        # warm model: loaded once when the service is created
+        self.model = GaiaDR3_GSPPhot_cal(configuration_file)[name]
+        self._queue = None
+        self._worker = None
+        self._latencies = deque(maxlen=history)
+        self._batch_sizes = {}
+        self._n_requests = 0
+        self._n_batches = 0
+
+    async def start(self):
+        """ Start the batching loop """
+        if self._worker is None:
+            self._queue = asyncio.Queue()
+            self._worker = asyncio.ensure_future(self._batch_loop())
+
+    async def stop(self):
+        """ Stop the batching loop """
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+
+    async def calibrate(self, data: Union[pandas.DataFrame, dict]) -> numpy.array:
+        """ Submit a request and wait for its calibrated values """
+        await self.start()
+        df = pandas.DataFrame(data)
+        if 'cosb' not in df.columns and 'b' in df.columns:
+            # the unit of b belongs to the request, not to the batch it joins
+            b_unit = resolve_b_unit(df, self.b_unit)
+            df['cosb'] = CalibrationModel.compute_cosb_from_dataframe(df, numpy.float64, b_unit)
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((df, future, time.perf_counter()))
+        return await future
+
+    async def _batch_loop(self):
+        """ Collect requests until the deadline or the size limit, then evaluate """
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = batch[0][2] + self.max_latency
+            n_rows = len(batch[0][0])
+            while n_rows < self.max_batch_size:
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                batch.append(item)
+                n_rows += len(item[0])
+            # model evaluation does not block the event loop
+            await loop.run_in_executor(None, self._process, batch)
+
+    def _process(self, batch: list):
+        """ Evaluate a batch; requests with the same columns are concatenated
+
+        If a concatenated group fails, its requests are evaluated one by one,
+        so that only the invalid requests get the error.
+        """
+        n_rows = sum(len(item[0]) for item in batch)
+        bucket = 1 << max(n_rows - 1, 0).bit_length()
+        self._batch_sizes[bucket] = self._batch_sizes.get(bucket, 0) + 1
+        self._n_requests += len(batch)
+        self._n_batches += 1
+
+        schemas = {}
+        for item in batch:
+            schemas.setdefault(tuple(item[0].columns), []).append(item)
+
+        groups = list(schemas.values())
+        while groups:
+            items = groups.pop()
+            frames = [item[0] for item in items]
+            try:
+                values = self.model(pandas.concat(frames, ignore_index=True))
+            except Exception as e:
+                if len(items) > 1:
+                    groups.extend([item] for item in items)
+                    continue
+                _, future, submitted = items[0]
+                self._latencies.append(time.perf_counter() - submitted)
+                future.get_loop().call_soon_threadsafe(_set_exception, future, e)
+                continue
+            start = 0
+            for df, future, submitted in items:
+                result = values[start: start + len(df)]
+                start += len(df)
+                self._latencies.append(time.perf_counter() - submitted)
+                future.get_loop().call_soon_threadsafe(_set_result, future, result)
+
+    def stats(self) -> dict:
+        """ Latency percentiles (seconds) and histogram of the batch sizes
+
+        The histogram counts batches per power-of-two upper bound of their number of rows.
+        """
+        latencies = numpy.array(self._latencies)
+        if len(latencies):
+            p50, p99 = numpy.percentile(latencies, [50, 99])
+        else:
+            p50 = p99 = float('nan')
+        return {'requests': self._n_requests,
+                'batches': self._n_batches,
+                'latency_p50': float(p50),
+                'latency_p99': float(p99),
+                'batch_size_histogram': {k: self._batch_sizes[k] for k in sorted(self._batch_sizes)}}
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """ Answer newline-delimited JSON requests of a client """
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    request = json.loads(line)
+                    if request.get('stats', False):
+                        response = {'stats': self.stats()}
+                    else:
+                        values = await self.calibrate(request['data'])
+                        response = {'values': [None if numpy.isnan(v) else float(v) for v in values]}
+                except Exception as e:
+                    response = {'error': f'{type(e).__name__}: {e}'}
+                writer.write(json.dumps(response).encode('utf8') + b'\n')
+                await writer.drain()
+        finally:
+            writer.close()
+
+    async def serve(self, unix_path: str = None, host: str = '127.0.0.1', port: int = 8642):
+        """ Serve requests on a Unix socket (if given) or on a local TCP port """
+        await self.start()
+        if unix_path is not None:
+            server = await asyncio.start_unix_server(self._handle_connection, path=unix_path)
+        else:
+            server = await asyncio.start_server(self._handle_connection, host=host, port=port)
+        async with server:
+            await server.serve_forever()
+
+
+def _set_result(future: asyncio.Future, result):
+    if not future.done():
+        future.set_result(result)
+
+
+def _set_exception(future: asyncio.Future, exception: Exception):
+    if not future.done():
+        future.set_exception(exception)
+
+
+def request_calibration(data: Union[pandas.DataFrame, dict], unix_path: str = None,
+                        host: str = '127.0.0.1', port: int = 8642) -> numpy.array:
+    """ Synchronous client: send one request to a running service """
+    if isinstance(data, pandas.DataFrame):
+        data = {k: data[k].tolist() for k in data.columns}
+    payload = json.dumps({'data': data}).encode('utf8') + b'\n'
+    if unix_path is not None:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(unix_path)
+    else:
+        sock = socket.create_connection((host, port))
+    with sock, sock.makefile('rb') as stream:
+        sock.sendall(payload)
+        response = json.loads(stream.readline())
+    if 'error' in response:
+        raise RuntimeError(response['error'])
+    return numpy.array([float('nan') if v is None else v for v in response['values']])
+
+
+def main(argv=None):
+    """ Command line entry point """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--unix', default=None, help='path of the Unix socket')
+    parser.add_argument('--host', default='127.0.0.1', help='TCP host (if no Unix socket)')
+    parser.add_argument('--port', default=8642, type=int, help='TCP port (if no Unix socket)')
+    parser.add_argument('--model', default='mh', help='model to serve')
+    parser.add_argument('--configuration', default=None, help='configuration file')
+    parser.add_argument('--max-latency', default=0.005, type=float,
+                        help='batching deadline in seconds')
+    parser.add_argument('--max-batch-size', default=100_000, type=int,
+                        help='maximum number of rows per batch')
+    parser.add_argument('--b-unit', default=None, choices=['deg', 'rad'],
+                        help='unit of b (default: guessed per request)')
+    args = parser.parse_args(argv)
+
+    service = CalibrationService(args.model, args.configuration,
+                                 max_latency=args.max_latency,
+                                 max_batch_size=args.max_batch_size,
+                                 b_unit=args.b_unit)
+    try:
+        asyncio.run(service.serve(args.unix, args.host, args.port))
+    except KeyboardInterrupt:
+        print(json.dumps(service.stats()), file=sys.stderr)
+    finally:
+        if args.unix is not None and os.path.exists(args.unix):
+            os.remove(args.unix)
+
+
+if __name__ == '__main__':
+    main()
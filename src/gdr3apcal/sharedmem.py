@@ -0,0 +1,188 @@
+""" Shared-memory calibration over a pool of processes
+
+Wrapping `calibrateMetallicity` in `multiprocessing` pickles the data frames to
+each worker and loads the models once per task. Here, the feature matrix, the
+labels, the library codes and the output are placed once in
+`multiprocessing.shared_memory`. Workers attach to the buffers without copy,
+evaluate ranges of rows and write their results directly into the shared
+output. The models are loaded once per worker by the pool initializer, which
+works with both the fork and spawn start methods.
+
+.. code-block:: python
+
+    from gdr3apcal.sharedmem import calibrate_shared
+    metal_calib = calibrate_shared(df, n_workers=8)
+"""
+import os
+import multiprocessing
+from typing import Tuple
+import numpy
+import pandas
+# local code
+from .partitions import get_collection
+from .calibration_models import CalibrationModelGrouped
+
+try:    # Python >= 3.8
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory = None
+
+
+__all__ = ['SharedCalibrationBuffers', 'calibrate_shared']
+
+
+def _require_shared_memory():
+    """ multiprocessing.shared_memory is only available from Python 3.8 """
+    if shared_memory is None:
+        raise ImportError("gdr3apcal.sharedmem requires Python 3.8 or later "
+                          "(multiprocessing.shared_memory).")
+
+
+class SharedCalibrationBuffers:
+    """ Features, labels, library codes, outputs and flags in shared memory
+
+    Create the buffers with :meth:`create` in the parent process, and attach
+    to them in workers with :meth:`attach` and the picklable :attr:`spec`.
+    """
+    _fields = ('X', 'values', 'codes', 'output', 'flags')
+
+    def __init__(self, spec: dict, segments: dict):
+        """ Constructor (use :meth:`create` or :meth:`attach`) """
+        self.spec = spec
+        self._segments = segments
+        n_rows, n_features = spec['shape']
+        dtype = numpy.dtype(spec['dtype'])
+        shapes = {'X': ((n_rows, n_features), dtype),
+                  'values': ((n_rows,), dtype),
+                  'codes': ((n_rows,), numpy.int8),
+                  'output': ((n_rows,), dtype),
+                  'flags': ((n_rows,), numpy.uint8)}
+        for field, segment in segments.items():
+            shape, field_dtype = shapes[field]
+            setattr(self, field, numpy.ndarray(shape, dtype=field_dtype, buffer=segment.buf))
+
+    @classmethod
+    def create(cls, n_rows: int, n_features: int, dtype: type = numpy.float64) -> 'SharedCalibrationBuffers':
+        """ Allocate new shared buffers """
+        _require_shared_memory()
+        dtype = numpy.dtype(dtype)
+        sizes = {'X': n_rows * n_features * dtype.itemsize,
+                 'values': n_rows * dtype.itemsize,
+                 'codes': n_rows,
+                 'output': n_rows * dtype.itemsize,
+                 'flags': n_rows}
+        # zero-size segments are not allowed
+        segments = {field: shared_memory.SharedMemory(create=True, size=max(size, 1))
+                    for field, size in sizes.items()}
+        spec = {'shape': (n_rows, n_features), 'dtype': dtype.str,
+                'names': {field: segment.name for field, segment in segments.items()}}
+        return cls(spec, segments)
+
+    @classmethod
+    def attach(cls, spec: dict) -> 'SharedCalibrationBuffers':
+        """ Attach to existing buffers (no copy) """
+        _require_shared_memory()
+        segments = {field: shared_memory.SharedMemory(name=name)
+                    for field, name in spec['names'].items()}
+        return cls(spec, segments)
+
+    def close(self):
+        """ Release the views and detach from the buffers """
+        for field in self._fields:
+            if hasattr(self, field):
+                delattr(self, field)
+        for segment in self._segments.values():
+            segment.close()
+
+    def unlink(self):
+        """ Free the buffers (creator only, after all processes closed them) """
+        for segment in self._segments.values():
+            segment.unlink()
+
+
+# per-process state of the pool workers
+_worker_state = {}
+
+
+def _init_worker(spec: dict, name: str, configuration_file: str):
+    """ Pool initializer: attach the buffers and load the model once """
+    _worker_state['buffers'] = SharedCalibrationBuffers.attach(spec)
+    _worker_state['model'] = get_collection(configuration_file)[name]
+
+
+def _calibrate_range(bounds: Tuple[int, int]) -> int:
+    """ Calibrate rows [start, stop) of the shared buffers in place """
+    start, stop = bounds
+    buffers = _worker_state['buffers']
+    model = _worker_state['model']
+    X = buffers.X[start: stop]
+    values = buffers.values[start: stop]
+    flags = buffers.flags[start: stop]
+    flags[:] = 0
+    if isinstance(model, CalibrationModelGrouped):
+        buffers.output[start: stop] = model.evaluate_codes(X, values, buffers.codes[start: stop], flags)
+    else:
+        buffers.output[start: stop] = model.evaluate(X, values, flags)
+    return stop - start
+
+
+def calibrate_shared(df: pandas.DataFrame, n_workers: int = None,
+                     chunk_size: int = 100_000, name: str = 'mh',
+                     configuration_file: str = None,
+                     dtype: type = numpy.float64,
+                     return_flags: bool = False,
+                     mp_context: str = None,
+                     b_unit: str = None) -> numpy.array:
+    """ Calibrate a frame over a pool of processes sharing the data in memory
+
+    Parameters
+    ----------
+    df: pandas.DataFrame
+        input data with the GACS column names
+    n_workers: int
+        number of processes (default: number of cpus)
+    chunk_size: int
+        number of rows per task
+    name: str
+        model to apply (default 'mh')
+    configuration_file: str
+        configuration of the models (default is the package configuration)
+    dtype: type
+        precision of the features and of the evaluation
+    return_flags: bool
+        also return the quality flags (see :class:`gdr3apcal.calibration_models.QualityFlag`)
+    mp_context: str
+        multiprocessing start method ('fork', 'spawn', 'forkserver'; default of the platform)
+    b_unit: str
+        unit of b ('deg' or 'rad') if cos(b) is computed from it (default: guessed)
+
+    returns
+    -------
+    calibrated: numpy.array
+        calibrated values (and flags if requested)
+    """
+    n_workers = os.cpu_count() if n_workers is None else n_workers
+    model = get_collection(configuration_file)[name]
+
+    buffers = SharedCalibrationBuffers.create(len(df), len(model.features), dtype)
+    try:
+        # features are extracted once in the parent, directly into shared memory
+        model._get_features(df, model.features, dtype, b_unit, out=buffers.X)
+        buffers.values[:] = df[model.label].values
+        if isinstance(model, CalibrationModelGrouped):
+            buffers.codes[:] = model.library_codes(df[model.groupby])
+
+        bounds = [(start, min(start + chunk_size, len(df))) for start in range(0, len(df), chunk_size)]
+        context = multiprocessing.get_context(mp_context)
+        with context.Pool(n_workers, initializer=_init_worker,
+                          initargs=(buffers.spec, name, configuration_file)) as pool:
+            pool.map(_calibrate_range, bounds)
+
+        output = buffers.output.copy()
+        flags = buffers.flags.copy()
+    finally:
+        buffers.close()
+        buffers.unlink()
+    if return_flags:
+        return output, flags
+    return output
@@ -0,0 +1,55 @@
+""" Shared test configuration """
+import os
+from typing import Sequence
+import numpy
+import pandas
+import pytest
+from gdr3apcal import calibration
+
+
+FEATURES = ['teff_gspphot', 'logg_gspphot', 'mh_gspphot', 'azero_gspphot',
+            'ebpminrp_gspphot', 'ag_gspphot', 'mg_gspphot', 'cosb']
+
+# plausible ranges of the features, e.g. to obtain meaningful calibrated values
+PHYSICAL_RANGES = {'teff_gspphot': (3500, 9000),
+                   'logg_gspphot': (1, 5),
+                   'mh_gspphot': (-2, 0.5),
+                   'azero_gspphot': (0, 2),
+                   'ebpminrp_gspphot': (0, 1),
+                   'ag_gspphot': (0, 2),
+                   'mg_gspphot': (-2, 8),
+                   'cosb': (0, 1)}
+
+
+def generate_random_data(n_rows: int = 2, seed: int = 0,
+                         libraries: Sequence[str] = ('PHOENIX', 'MARCS', 'A', 'OB'),
+                         ranges: dict = None, source_id: bool = False) -> pandas.DataFrame:
+    """ Data generator that does not alter the global random state
+
+    Features are uniform in [0, 1] unless ranges gives {feature: (low, high)}.
+    With source_id, adds increasing Gaia source_id spread over the sky.
+    """
+    rng = numpy.random.default_rng(seed)
+    ranges = ranges or {}
+    df = pandas.DataFrame({name: rng.uniform(*ranges.get(name, (0.0, 1.0)), n_rows) for name in FEATURES})
+    df['libname_gspphot'] = rng.choice(list(libraries), n_rows)
+    if source_id:
+        pixels = numpy.sort(rng.integers(0, 12 * 4 ** 12, n_rows))
+        df['source_id'] = pixels * 2 ** 35 + rng.integers(0, 2 ** 35, n_rows)
+    return df
+
+
+@pytest.fixture(autouse=True, scope='session')
+def model_cache(tmp_path_factory):
+    """ Compiled model artifacts go to a temporary directory, not to ~/.cache """
+    cachedir = str(tmp_path_factory.mktemp('gdr3apcal-cache'))
+    previous = (os.environ.get('GDR3APCAL_CACHE'), calibration.cachedir)
+    # the environment variable covers the spawned worker processes
+    os.environ['GDR3APCAL_CACHE'] = cachedir
+    calibration.cachedir = cachedir
+    yield cachedir
+    if previous[0] is None:
+        del os.environ['GDR3APCAL_CACHE']
+    else:
+        os.environ['GDR3APCAL_CACHE'] = previous[0]
+    calibration.cachedir = previous[1]
@@ -0,0 +1,110 @@
+""" Unit tests for the streaming aggregation of calibrated values """
+import numpy
+import pandas
+import pytest
+from gdr3apcal.calibration import GaiaDR3_GSPPhot_cal
+from gdr3apcal.calibration_models import QualityFlag
+from gdr3apcal.aggregation import (HealpixBinning, GridBinning, BinnedStatistics,
+                                   aggregate_calibration)
+from gdr3apcal.runner import healpix_from_source_id
+from conftest import generate_random_data, PHYSICAL_RANGES
+
+
+def test_binned_statistics_merge() -> None:
+    """ merged partial statistics match the direct computation """
+    rng = numpy.random.default_rng(2)
+    bins = rng.integers(-1, 10, 5000)
+    values = rng.normal(-0.5, 0.3, 5000)
+    values[:10] = numpy.nan
+
+    full = BinnedStatistics(10).update(bins, values)
+    merged = BinnedStatistics(10).update(bins[:1234], values[:1234])
+    merged.merge(BinnedStatistics(10).update(bins[1234:], values[1234:]))
+
+    keep = (bins >= 0) & numpy.isfinite(values)
+    expected = pandas.Series(values[keep]).groupby(bins[keep]).agg(['count', 'mean', 'var', 'median'])
+    for stats in (full, merged):
+        numpy.testing.assert_array_equal(stats.count, expected['count'])
+        numpy.testing.assert_allclose(stats.mean, expected['mean'])
+        numpy.testing.assert_allclose(stats.variance, expected['var'])
+        numpy.testing.assert_array_equal(stats.sketch, full.sketch)
+        # sketches have a resolution of 0.02
+        numpy.testing.assert_allclose(stats.quantile(0.5)[:, 0], expected['median'], atol=0.02)
+
+
+def test_aggregate_healpix_and_grid() -> None:
+    """ streamed aggregates match the binning of the full calibrated column """
+    df = generate_random_data(2000, libraries=('PHOENIX', 'MARCS', 'A'),
+                              ranges=PHYSICAL_RANGES, source_id=True)
+    values = GaiaDR3_GSPPhot_cal().calibrateMetallicity(df.copy())
+    pixels = healpix_from_source_id(df['source_id'].values, 1)
+    expected = pandas.Series(values).groupby(pixels).agg(['count', 'mean'])
+
+    binning = HealpixBinning(level=1)
+    stats = aggregate_calibration(df, binning, chunk_size=300)
+    skymap = stats.to_frame(binning)
+    assert skymap['healpix'].tolist() == expected.index.tolist()
+    numpy.testing.assert_array_equal(skymap['count'], expected['count'])
+    numpy.testing.assert_allclose(skymap['mean'], expected['mean'])
+
+    # partitions over processes, and quality selection
+    partitions = {'a': df.iloc[:1000], 'b': df.iloc[1000:]}
+    parallel = GaiaDR3_GSPPhot_cal().aggregateMetallicity(partitions, binning, n_workers=2)
+    numpy.testing.assert_array_equal(parallel.count, stats.count)
+    numpy.testing.assert_allclose(parallel.mean, stats.mean)
+    selected = aggregate_calibration(df, binning, exclude_flags=QualityFlag.OUTSIDE_TRAINING_DOMAIN)
+    _, flags = GaiaDR3_GSPPhot_cal().calibrateMetallicity(df.copy(), return_flags=True)
+    good = numpy.isfinite(values) & ~(flags & QualityFlag.OUTSIDE_TRAINING_DOMAIN).astype(bool)
+    assert 0 < selected.count.sum() == good.sum() < stats.count.sum()
+
+    grid = GridBinning({'teff_gspphot': [4000, 5000, 6000, 7000], 'logg_gspphot': [1, 3, 5]})
+    table = aggregate_calibration(df, grid).to_frame(grid, quantiles=[0.5])
+    assert len(table) == 6
+    inside = (df['teff_gspphot'] >= 4000) & (df['teff_gspphot'] <= 7000) & numpy.isfinite(values)
+    assert table['count'].sum() == inside.sum()
+    row = table[(table['teff_gspphot'] == 4500) & (table['logg_gspphot'] == 2)]
+    selection = inside & (df['teff_gspphot'] < 5000) & (df['logg_gspphot'] < 3)
+    numpy.testing.assert_allclose(row['mean'], values[selection].mean())
+
+
+def test_aggregate_b_unit() -> None:
+    """ the unit of b is decided once, never per chunk """
+    df = generate_random_data(400, libraries=('PHOENIX', 'MARCS', 'A'),
+                              ranges=PHYSICAL_RANGES, source_id=True).drop(columns='cosb')
+    df['b'] = numpy.where(numpy.arange(400) < 200, 1.2, 60.)
+    binning = HealpixBinning(level=1)
+    expected = aggregate_calibration(df, binning, chunk_size=100)
+    explicit = aggregate_calibration(df, binning, chunk_size=100, b_unit='deg')
+    numpy.testing.assert_array_equal(explicit.count, expected.count)
+    numpy.testing.assert_allclose(explicit.mean, expected.mean)
+
+    chunks = [df.iloc[:200], df.iloc[200:]]
+    with pytest.raises(ValueError):
+        aggregate_calibration(chunks, binning)
+    streamed = aggregate_calibration(chunks, binning, b_unit='deg')
+    numpy.testing.assert_allclose(streamed.mean, expected.mean)
+
+
+def test_sparse_sketches() -> None:
+    """ the sketches of fine maps only store the filled cells """
+    rng = numpy.random.default_rng(5)
+    n_bins = 12 * 4 ** 7
+    bins = rng.integers(0, n_bins, 3000)
+    values = rng.normal(-0.5, 0.3, 3000)
+    stats = BinnedStatistics(n_bins)
+    for start in range(0, 3000, 300):
+        stats.merge(BinnedStatistics(n_bins).update(bins[start: start + 300], values[start: start + 300]))
+    cells, counts = stats.sketch_cells()
+    assert counts.sum() == 3000
+    assert len(cells) <= 3000
+
+    # quantiles interpolated in the sparse cells match the dense histograms
+    small = BinnedStatistics(4).update(bins % 4, values)
+    cells, counts = small.sketch_cells()
+    dense = small.sketch
+    numpy.testing.assert_array_equal(dense.reshape(-1)[cells], counts)
+    edges = numpy.linspace(-5., 2., 351)
+    for k in range(4):
+        cdf = numpy.concatenate([[0.], numpy.cumsum(dense[k]) / dense[k].sum()])
+        expected = numpy.interp([0.16, 0.5, 0.84], cdf, edges)
+        numpy.testing.assert_allclose(small.quantile([0.16, 0.5, 0.84])[k], expected, atol=1e-12)
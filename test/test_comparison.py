@@ -0,0 +1,65 @@
+""" Unit tests for the side-by-side evaluation of releases """
+import os
+import numpy
+import yaml
+from gdr3apcal.calibration import GaiaDR3_GSPPhot_cal
+from gdr3apcal.calibration_models import CalibrationModelGrouped
+from gdr3apcal.comparison import DifferenceStatistics, compare_versions
+from gdr3apcal.config import __PACKAGE_DIR__
+from conftest import generate_random_data, PHYSICAL_RANGES
+
+
+def test_difference_statistics() -> None:
+    """ streaming and merged statistics match the direct computation """
+    rng = numpy.random.default_rng(3)
+    reference = rng.normal(size=1000)
+    other = reference + rng.normal(0.1, 0.01, size=1000)
+    other[:5] = numpy.nan
+    diff = (other - reference)[5:]
+
+    full = DifferenceStatistics().update(reference, other).result()
+    merged = DifferenceStatistics().update(reference[:300], other[:300])
+    merged.merge(DifferenceStatistics().update(reference[300:], other[300:]))
+    for stats in (full, merged.result()):
+        assert stats['n'] == 995
+        assert stats['nan_mismatch'] == 5
+        numpy.testing.assert_allclose(stats['mean'], diff.mean())
+        numpy.testing.assert_allclose(stats['rms'], numpy.sqrt((diff ** 2).mean()))
+        numpy.testing.assert_allclose(stats['max_abs'], numpy.abs(diff).max(), rtol=1e-10)
+
+
+def test_compare_versions(tmp_path) -> None:
+    """ releases evaluated side by side give the same values as separately """
+    with open(os.path.join(__PACKAGE_DIR__, 'configuration.yaml'), encoding='utf8') as fin:
+        config = yaml.safe_load(fin)
+    config['mh']['version'] = '0.8rc1'
+    candidate = str(tmp_path / 'candidate.yaml')
+    with open(candidate, 'w', encoding='utf8') as fout:
+        yaml.safe_dump(config, fout)
+
+    df = generate_random_data(100, libraries=['PHOENIX', 'MARCS', 'A', None],
+                              ranges=dict(PHYSICAL_RANGES, teff_gspphot=(4000, 8000)))
+    calib = GaiaDR3_GSPPhot_cal()
+    expected = calib.calibrateMetallicity(df.copy())
+    values, stats = calib.compareVersions(df, [candidate], chunk_size=30)
+    assert list(values.columns) == ['0.7', '0.8rc1']
+    # chunks only change the rounding of the matrix products
+    numpy.testing.assert_allclose(values['0.7'], expected, rtol=0, atol=1e-12)
+    numpy.testing.assert_array_equal(values['0.8rc1'], values['0.7'])
+    assert stats['version'].tolist() == ['0.8rc1']
+    assert stats['n'][0] == numpy.isfinite(expected).sum()
+    assert stats['max_abs'][0] == 0 and stats['nan_mismatch'][0] == 0
+
+    # chunks of data and statistics only, with a different candidate model
+    reference = calib['mh']
+    submodels = dict(reference.model, mh_phoenix=reference.model['mh_marcs'])
+    candidate = CalibrationModelGrouped('mh', submodels, reference.features,
+                                        reference.label, reference.groupby)
+    chunks = (df.iloc[k: k + 25].copy() for k in range(0, len(df), 25))
+    values, stats = compare_versions(chunks, {'reference': reference, 'candidate': candidate},
+                                     return_values=False)
+    assert values is None
+    phoenix = (df['libname_gspphot'] == 'PHOENIX').values
+    diff = reference.model['mh_marcs'](df[phoenix].copy()) - expected[phoenix]
+    assert stats['n'][0] == numpy.isfinite(expected).sum()
+    numpy.testing.assert_allclose(stats['max_abs'][0], numpy.abs(diff).max(), rtol=1e-10)
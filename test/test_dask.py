@@ -0,0 +1,84 @@
+""" Unit tests for the dask integration """
+import numpy
+import pytest
+from gdr3apcal.calibration import GaiaDR3_GSPPhot_cal
+from gdr3apcal.dask_calibration import is_dask_dataframe
+from conftest import generate_random_data
+
+dd = pytest.importorskip("dask.dataframe")
+
+
+def test_dask_matches_pandas() -> None:
+    """ partition-wise calibration gives the in-memory result """
+    df_raw = generate_random_data(50)
+    calib = GaiaDR3_GSPPhot_cal()
+    expected = calib.calibrateMetallicity(df_raw.copy())
+
+    ddf = dd.from_pandas(df_raw, npartitions=4)
+    result = calib.calibrateMetallicity(ddf)
+    assert result.name == 'mh_calibrated'
+    values = result.compute(scheduler='sync')
+    assert len(values) == len(df_raw)
+    numpy.testing.assert_allclose(values.values, expected, rtol=0, atol=1e-10)
+
+
+def test_dask_local_cluster() -> None:
+    """ run through a distributed LocalCluster """
+    distributed = pytest.importorskip("distributed")
+    df_raw = generate_random_data(40)
+    expected = GaiaDR3_GSPPhot_cal().calibrateMetallicity(df_raw.copy())
+
+    with distributed.LocalCluster(n_workers=2, threads_per_worker=1,
+                                  processes=False, dashboard_address=None) as cluster:
+        with distributed.Client(cluster) as client:
+            ddf = dd.from_pandas(df_raw, npartitions=3)
+            values = client.compute(GaiaDR3_GSPPhot_cal().calibrateMetallicity(ddf)).result()
+    numpy.testing.assert_allclose(values.sort_index().values, expected, rtol=0, atol=1e-10)
+
+
+def test_dask_b_unit_decided_once() -> None:
+    """ a partition close to the Galactic plane does not switch b to radians """
+    df_raw = generate_random_data(40).drop(columns='cosb')
+    # b in degrees: the first partition alone would look like radians
+    df_raw['b'] = numpy.where(numpy.arange(40) < 20, 1.2, 60.)
+    calib = GaiaDR3_GSPPhot_cal()
+    expected = calib.calibrateMetallicity(df_raw.copy())
+    explicit = calib.calibrateMetallicity(df_raw.copy(), b_unit='deg')
+    numpy.testing.assert_array_equal(explicit, expected)
+
+    ddf = dd.from_pandas(df_raw, npartitions=2)
+    assert ddf.partitions[0]['b'].abs().max().compute() < numpy.pi / 2
+    values = calib.calibrateMetallicity(ddf).compute(scheduler='sync')
+    numpy.testing.assert_allclose(values.values, expected, rtol=0, atol=1e-10)
+
+
+def test_dask_dtype_and_flags() -> None:
+    """ precision and quality flags are passed to the partitions """
+    df_raw = generate_random_data(30)
+    calib = GaiaDR3_GSPPhot_cal()
+    expected, expected_flags = calib.calibrateMetallicity(df_raw.copy(), dtype=numpy.float32,
+                                                          return_flags=True)
+    ddf = dd.from_pandas(df_raw, npartitions=3)
+    result = calib.calibrateMetallicity(ddf, dtype=numpy.float32, return_flags=True)
+    assert list(result.columns) == ['mh_calibrated', 'mh_flags']
+    assert result.dtypes['mh_calibrated'] == numpy.float32
+    computed = result.compute(scheduler='sync')
+    assert computed.dtypes['mh_calibrated'] == numpy.float32
+    assert computed.dtypes['mh_flags'] == numpy.uint8
+    numpy.testing.assert_allclose(computed['mh_calibrated'].values, expected, rtol=0, atol=1e-5)
+    numpy.testing.assert_array_equal(computed['mh_flags'].values, expected_flags)
+
+    single = calib.calibrateMetallicity(ddf, dtype=numpy.float32)
+    assert single.dtype == numpy.float32
+    assert single.compute(scheduler='sync').dtype == numpy.float32
+
+
+def test_is_dask_dataframe() -> None:
+    """ dask collections are detected, also those of the dask_expr package """
+    df_raw = generate_random_data(10)
+    assert is_dask_dataframe(dd.from_pandas(df_raw, npartitions=2))
+    assert not is_dask_dataframe(df_raw)
+    # dask 2024.3-2024.12 collections live in the dask_expr package
+    expr_frame = type('DataFrame', (), {'__module__': 'dask_expr._collection',
+                                        'map_partitions': lambda self: None})
+    assert is_dask_dataframe(expr_frame())
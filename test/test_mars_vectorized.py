@@ -0,0 +1,111 @@
+""" Unit tests for the vectorized MARS evaluation and the float32 mode """
+import numpy
+import pandas
+from gdr3apcal.calibration import GaiaDR3_GSPPhot_cal
+from gdr3apcal import calibration
+from gdr3apcal.mars_vectorized import VectorizedMarsFunction, compile_models, save_models, load_models
+from gdr3apcal.precision import float32_deviation_report
+from gdr3apcal.models import mars_mh
+
+
+def generate_random_features(n_rows: int = 500, seed: int = 5) -> numpy.array:
+    """ features covering and exceeding the knots of the models """
+    rng = numpy.random.default_rng(seed)
+    X = rng.uniform(0.0, 1.0, [n_rows, 8])
+    X[:, 0] = rng.uniform(3000, 9000, n_rows)
+    X[:, 1] = rng.uniform(1, 5.5, n_rows)
+    X[:, 2] = rng.uniform(-3.5, 1, n_rows)
+    X[:, 6] = rng.uniform(-3, 10, n_rows)
+    return X
+
+
+def test_vectorized_matches_source() -> None:
+    """ parsed model gives the row-by-row results """
+    X = generate_random_features()
+    for name in ('mh_phoenix', 'mh_marcs'):
+        fn = mars_mh.models[name]
+        model = VectorizedMarsFunction.from_function(fn)
+        assert model.calibrated
+        expected = numpy.array(list(fn(X)))
+        numpy.testing.assert_allclose(model(X), expected, rtol=0, atol=1e-12)
+
+
+def test_vectorized_null_model() -> None:
+    """ uncalibrated libraries give NaN """
+    model = VectorizedMarsFunction.from_function(mars_mh.mh_null)
+    assert not model.calibrated
+    assert numpy.isnan(model(generate_random_features(3))).all()
+
+
+def test_float32_calibration() -> None:
+    """ the float32 mode stays close to float64 """
+    rng = numpy.random.default_rng(6)
+    df = pandas.DataFrame(generate_random_features(100),
+                          columns=['teff_gspphot', 'logg_gspphot', 'mh_gspphot', 'azero_gspphot',
+                                   'ebpminrp_gspphot', 'ag_gspphot', 'mg_gspphot', 'cosb'])
+    df['libname_gspphot'] = rng.choice(['PHOENIX', 'MARCS'], len(df))
+    calib = GaiaDR3_GSPPhot_cal()
+    reference = calib.calibrateMetallicity(df)
+    single = calib.calibrateMetallicity(df, dtype=numpy.float32)
+    assert single.dtype == numpy.float32
+    numpy.testing.assert_allclose(single, reference, rtol=0, atol=1e-3)
+
+
+def test_float32_deviation_report() -> None:
+    """ float32 is safe over the training domain """
+    report = float32_deviation_report(n_samples=20_000)
+    assert set(report['model']) == {'mh_phoenix', 'mh_marcs'}
+    assert report['n'].sum() == 40_000
+    assert report['safe'].all()
+    # the configured training domain (3800-8500 K), not only the knots
+    for _, bins in report.groupby('model'):
+        assert bins['teff_min'].min() == 3800
+        assert bins['teff_max'].max() == 8500
+
+
+def test_compiled_artifacts(tmp_path, monkeypatch) -> None:
+    """ cached artifacts give the same results as the compiled source """
+    X = generate_random_features()
+    compiled = compile_models(mars_mh.models)
+    fname = str(tmp_path / 'mh.npz')
+    save_models(fname, compiled)
+    loaded = load_models(fname)
+    assert set(loaded) == set(compiled)
+    for name, model in compiled.items():
+        assert loaded[name].checksum() == model.checksum()
+        numpy.testing.assert_array_equal(loaded[name](X), model(X))
+
+    # the loader writes the artifact once, then reads it back
+    monkeypatch.setattr(calibration, 'cachedir', str(tmp_path / 'cache'))
+    modelfile = mars_mh.__file__
+    artifact = calibration._compiled_artifact_file('mh', modelfile)
+    first = calibration._load_callable_models('mh', modelfile, 'gdr3apcal.models.mars_mh')
+    assert (tmp_path / 'cache').joinpath(artifact.split('/')[-1]).exists()
+    second = calibration._load_callable_models('mh', modelfile, 'gdr3apcal.models.mars_mh')
+    for name, model in first.items():
+        numpy.testing.assert_array_equal(second[name](X), model(X))
+
+    # a truncated artifact is compiled again and overwritten
+    with open(artifact, 'rb') as fin:
+        content = fin.read()
+    with open(artifact, 'wb') as fout:
+        fout.write(content[:len(content) // 2])
+    third = calibration._load_callable_models('mh', modelfile, 'gdr3apcal.models.mars_mh')
+    for name, model in first.items():
+        numpy.testing.assert_array_equal(third[name](X), model(X))
+    assert set(load_models(artifact)) == set(first)
+
+
+def test_float32_does_not_store_reduced_cosb() -> None:
+    """ cos(b) stored in the input frame keeps the full precision """
+    rng = numpy.random.default_rng(7)
+    df = pandas.DataFrame(generate_random_features(50)[:, :7],
+                          columns=['teff_gspphot', 'logg_gspphot', 'mh_gspphot', 'azero_gspphot',
+                                   'ebpminrp_gspphot', 'ag_gspphot', 'mg_gspphot'])
+    df['libname_gspphot'] = rng.choice(['PHOENIX', 'MARCS'], len(df))
+    df['b'] = rng.uniform(-90, 90, len(df))
+    calib = GaiaDR3_GSPPhot_cal()
+    reference = calib.calibrateMetallicity(df.copy())
+    calib.calibrateMetallicity(df, dtype=numpy.float32)
+    assert df['cosb'].dtype == numpy.float64
+    numpy.testing.assert_array_equal(calib.calibrateMetallicity(df), reference)
@@ -104,3 +104,91 @@ def test_automatic_conversion_radec_to_cosb():
     df_cal = calib['mh'](df_raw)
     assert(numpy.all(numpy.isfinite(df_cal)))
 
+
+def test_metallicity_quality_flags():
+    """ test the quality flags computed with the calibration """
+    from gdr3apcal.calibration_models import QualityFlag
+
+    calib = GaiaDR3_GSPPhot_cal()
+    df_raw = generate_random_data(5)
+    df_raw['teff_gspphot'] = 5000.
+    df_raw['logg_gspphot'] = 4.
+    df_raw['mh_gspphot'] = -0.5
+    df_raw['azero_gspphot'] = 1.
+    df_raw['ebpminrp_gspphot'] = 0.5
+    df_raw['ag_gspphot'] = 1.
+    df_raw['mg_gspphot'] = 4.
+    df_raw['cosb'] = 0.9
+    df_raw['libname_gspphot'] = ['PHOENIX', 'MARCS', 'A', 'MARCS', 'PHOENIX']
+    df_raw.at[3, 'teff_gspphot'] = float('nan')
+    df_raw.at[4, 'teff_gspphot'] = 9000.
+
+    values, flags = calib.calibrateMetallicity(df_raw, return_flags=True)
+    assert flags.dtype == numpy.uint8
+    numpy.testing.assert_array_equal(values, calib.calibrateMetallicity(df_raw))
+    assert flags[2] & QualityFlag.UNCALIBRATED_LIBRARY
+    assert flags[3] & QualityFlag.NAN_INPUT
+    assert flags[4] & QualityFlag.OUTSIDE_TRAINING_DOMAIN
+    assert flags[4] & QualityFlag.EXTRAPOLATION
+    assert (flags[:2] == 0).all()
+
+def test_metallicity_library_encodings():
+    """ test categorical and integer coded library columns """
+    from gdr3apcal.calibration_models import QualityFlag
+    calib = GaiaDR3_GSPPhot_cal()
+    df_raw = generate_random_data(20)
+    expected = calib.calibrateMetallicity(df_raw.copy())
+
+    model = calib['mh']
+    df_raw['libname_gspphot'] = model.encode_libraries(df_raw['libname_gspphot'])
+    assert isinstance(df_raw['libname_gspphot'].dtype, pandas.CategoricalDtype)
+    numpy.testing.assert_array_equal(calib.calibrateMetallicity(df_raw.copy()), expected)
+
+    df_raw['libname_gspphot'] = df_raw['libname_gspphot'].cat.codes
+    numpy.testing.assert_array_equal(calib.calibrateMetallicity(df_raw.copy()), expected)
+
+    # nullable integer codes with NA (e.g. read from parquet)
+    nullable = df_raw.copy()
+    nullable['libname_gspphot'] = nullable['libname_gspphot'].astype('Int8')
+    nullable.loc[[0, 5], 'libname_gspphot'] = None
+    values, flags = calib.calibrateMetallicity(nullable, return_flags=True)
+    assert numpy.isnan(values[[0, 5]]).all()
+    assert (flags[[0, 5]] & QualityFlag.NAN_INPUT).all()
+    keep = numpy.ones(len(values), dtype=bool)
+    keep[[0, 5]] = False
+    numpy.testing.assert_allclose(values[keep], expected[keep], rtol=0, atol=1e-12)
+    # -1 is missing, other negative codes are invalid
+    nullable.loc[0, 'libname_gspphot'] = -1
+    assert numpy.isnan(calib.calibrateMetallicity(nullable.copy())[0])
+    for code in (-5, -128, len(model.libraries)):
+        nullable.loc[0, 'libname_gspphot'] = code
+        try:
+            calib.calibrateMetallicity(nullable.copy())
+            assert False
+        except KeyError as key_error:
+            assert str(code) in str(key_error)
+
+    df_raw['libname_gspphot'] = 'UNKNOWN'
+    try:
+        calib.calibrateMetallicity(df_raw)
+        assert False
+    except KeyError as key_error:
+        assert 'UNKNOWN' in str(key_error)
+
+def test_metallicity_update_changed_submodels():
+    """ test that only the rows of changed sub-models are recomputed """
+    calib = GaiaDR3_GSPPhot_cal()
+    df_raw = generate_random_data(20)
+    df_raw['libname_gspphot'] = ['MARCS', 'PHOENIX'] * 10
+    expected = calib.calibrateMetallicity(df_raw.copy())
+
+    versions = calib.subModelVersions('mh')
+    assert set(versions) == {'mh_phoenix', 'mh_marcs', 'mh_a', 'mh_ob'}
+    previous = dict(versions, mh_marcs={'version': '0.6', 'md5sum': 'old'})
+
+    df_raw['mh_calibrated'] = 0.
+    updated = calib.updateCalibration(df_raw, previous)
+    assert (updated == (df_raw['libname_gspphot'] == 'MARCS')).all()
+    numpy.testing.assert_allclose(df_raw['mh_calibrated'][updated], expected[updated])
+    assert (df_raw['mh_calibrated'][~updated] == 0).all()
+    assert not calib.updateCalibration(df_raw, versions).any()
@@ -0,0 +1,113 @@
+""" Unit tests for the checkpointed calibration runner """
+import os
+import json
+import numpy
+import pandas
+import pytest
+from gdr3apcal.calibration import GaiaDR3_GSPPhot_cal
+from gdr3apcal.partitions import SourceIdRange
+from gdr3apcal.runner import (CalibrationRunner, healpix_from_source_id,
+                              partition_by_file, partition_by_healpix)
+from conftest import generate_random_data
+
+
+def test_healpix_from_source_id() -> None:
+    """ source_id encodes the level-12 HEALPix index """
+    source_id = 5 * 2 ** 35 * 4 ** 12 + 123
+    assert healpix_from_source_id(source_id, 12) == 5 * 4 ** 12
+    assert healpix_from_source_id(source_id, 0) == 5
+
+
+def test_runner_resumes(tmp_path) -> None:
+    """ only unfinished partitions are recomputed """
+    df = generate_random_data(60, libraries=('PHOENIX', 'MARCS'), source_id=True)
+    files = []
+    for k, chunk in enumerate(numpy.array_split(numpy.arange(len(df)), 3)):
+        fname = str(tmp_path / f'input-{k:d}.csv')
+        df.iloc[chunk].to_csv(fname, index=False)
+        files.append(fname)
+
+    outdir = str(tmp_path / 'output')
+    runner = CalibrationRunner(outdir, n_workers=1)
+    stats = runner.run(partition_by_file(files))
+    assert len(stats) == 3
+
+    # simulate a failure on the second partition
+    with open(runner.manifest_file) as fin:
+        manifest = json.load(fin)
+    assert manifest['model']['version'] == runner.model_info['version']
+    del manifest['partitions']['input-1']
+    with open(runner.manifest_file, 'w') as fout:
+        json.dump(manifest, fout)
+
+    stats = runner.run(partition_by_file(files))
+    assert list(stats['partition']) == ['input-1']
+
+    result = pandas.concat([pandas.read_csv(runner.output_file(f'input-{k:d}')) for k in range(3)])
+    expected = GaiaDR3_GSPPhot_cal().calibrateMetallicity(df.copy())
+    numpy.testing.assert_allclose(result['mh_calibrated'].values, expected, atol=1e-10)
+    numpy.testing.assert_array_equal(result['source_id'].values, df['source_id'].values)
+
+
+def test_runner_process_pool_healpix(tmp_path) -> None:
+    """ HEALPix partitions scheduled on a process pool """
+    df = generate_random_data(40, libraries=('PHOENIX', 'MARCS'), source_id=True)
+    partitions = partition_by_healpix(df, level=1)
+    runner = CalibrationRunner(str(tmp_path), n_workers=2)
+    stats = runner.run(partitions)
+    assert stats['rows'].sum() == len(df)
+    assert sorted(os.listdir(str(tmp_path))) == sorted(
+        [runner.manifest_name] + [os.path.basename(runner.output_file(k)) for k in partitions])
+    assert len(runner.run(partitions)) == 0
+
+
+def test_runner_updates_changed_submodels(tmp_path) -> None:
+    """ a sub-model release only recomputes its rows """
+    df = generate_random_data(30, libraries=('PHOENIX', 'MARCS'), source_id=True)
+    partitions = partition_by_healpix(df, level=0)
+    runner = CalibrationRunner(str(tmp_path), n_workers=1)
+    runner.run(partitions)
+
+    # pretend the partitions were produced by an older MARCS model
+    with open(runner.manifest_file) as fin:
+        manifest = json.load(fin)
+    for record in manifest['partitions'].values():
+        record['submodels']['mh_marcs'] = {'version': '0.6', 'md5sum': 'old'}
+    with open(runner.manifest_file, 'w') as fout:
+        json.dump(manifest, fout)
+
+    stats = runner.run(partitions)
+    assert (stats['mode'] == 'update').all()
+    assert stats['rows'].sum() == (df['libname_gspphot'] == 'MARCS').sum()
+    assert len(runner.run(partitions)) == 0
+
+    result = pandas.concat([pandas.read_csv(runner.output_file(k)) for k in partitions])
+    expected = GaiaDR3_GSPPhot_cal().calibrateMetallicity(df.copy())
+    numpy.testing.assert_allclose(result['mh_calibrated'].values, expected, atol=1e-10)
+
+
+def test_runner_lazy_healpix_files(tmp_path) -> None:
+    """ HEALPix partitions of files are read by the workers """
+    pytest.importorskip("pyarrow")
+    df = generate_random_data(60, libraries=('PHOENIX', 'MARCS'), source_id=True)
+    files = []
+    # the pixels overlap the files
+    for k, chunk in enumerate(numpy.array_split(numpy.arange(len(df)), 3)):
+        fname = str(tmp_path / ('input-{0:d}.{1:s}'.format(k, 'parquet' if k == 2 else 'csv')))
+        if fname.endswith('.parquet'):
+            df.iloc[chunk].to_parquet(fname, index=False)
+        else:
+            df.iloc[chunk].to_csv(fname, index=False)
+        files.append(fname)
+
+    partitions = partition_by_healpix(files, level=0)
+    assert all(isinstance(spec, SourceIdRange) for spec in partitions.values())
+    assert sum(len(spec.files) for spec in partitions.values()) > len(partitions)
+    runner = CalibrationRunner(str(tmp_path / 'output'), n_workers=2)
+    stats = runner.run(partitions)
+    assert stats['rows'].sum() == len(df)
+
+    result = pandas.concat([pandas.read_csv(runner.output_file(k)) for k in sorted(partitions)])
+    expected = GaiaDR3_GSPPhot_cal().calibrateMetallicity(df.copy())
+    numpy.testing.assert_array_equal(result['source_id'].values, df['source_id'].values)
+    numpy.testing.assert_allclose(result['mh_calibrated'].values, expected, atol=1e-10)
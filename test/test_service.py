@@ -0,0 +1,86 @@
+""" Unit tests for the micro-batching service """
+import os
+import socket
+import asyncio
+import numpy
+import pytest
+from gdr3apcal.calibration import GaiaDR3_GSPPhot_cal
+from gdr3apcal.service import CalibrationService, request_calibration
+from conftest import generate_random_data
+
+
+def test_service_coalesces_requests() -> None:
+    """ concurrent requests are batched and results dispatched in order """
+    df = generate_random_data(60, libraries=('PHOENIX', 'MARCS'))
+    expected = GaiaDR3_GSPPhot_cal().calibrateMetallicity(df.copy())
+    chunks = numpy.array_split(numpy.arange(len(df)), 20)
+
+    async def run():
+        service = CalibrationService(max_latency=0.05)
+        results = await asyncio.gather(*[service.calibrate(df.iloc[c].reset_index(drop=True))
+                                         for c in chunks])
+        await service.stop()
+        return service, results
+
+    service, results = asyncio.run(run())
+    numpy.testing.assert_allclose(numpy.concatenate(results), expected, atol=1e-10)
+    stats = service.stats()
+    assert stats['requests'] == 20
+    assert stats['batches'] < 20
+    assert sum(stats['batch_size_histogram'].values()) == stats['batches']
+    assert stats['latency_p50'] <= stats['latency_p99']
+
+
+def test_service_errors_are_per_request() -> None:
+    """ an invalid request does not fail the others, even with the same columns """
+    df = generate_random_data(4, libraries=('PHOENIX', 'MARCS'))
+    expected = GaiaDR3_GSPPhot_cal().calibrateMetallicity(df.copy())
+    unknown = df.copy()
+    unknown['libname_gspphot'] = 'FOO'
+
+    async def run():
+        service = CalibrationService(max_latency=0.05)
+        good = service.calibrate(df)
+        bad = service.calibrate(df.drop(columns=['ag_gspphot']))
+        bad_library = service.calibrate(unknown)
+        other = service.calibrate(df)
+        results = await asyncio.gather(good, bad, bad_library, other, return_exceptions=True)
+        await service.stop()
+        return service, results
+
+    service, (good, bad, bad_library, other) = asyncio.run(run())
+    numpy.testing.assert_allclose(good, expected, atol=1e-10)
+    numpy.testing.assert_allclose(other, expected, atol=1e-10)
+    assert isinstance(bad, KeyError)
+    assert isinstance(bad_library, KeyError) and 'FOO' in str(bad_library)
+    assert service.stats()['batches'] == 1
+
+
+@pytest.mark.skipif(not hasattr(socket, 'AF_UNIX'), reason="Unix sockets are not available")
+def test_service_unix_socket(tmp_path) -> None:
+    """ round trip through the Unix socket server """
+    df = generate_random_data(5, libraries=('PHOENIX', 'MARCS'))
+    expected = GaiaDR3_GSPPhot_cal().calibrateMetallicity(df.copy())
+    path = str(tmp_path / 'gdr3apcal.sock')
+
+    async def run():
+        service = CalibrationService()
+        server = asyncio.ensure_future(service.serve(unix_path=path))
+        # wait for the server to listen
+        for _ in range(500):
+            if os.path.exists(path) or server.done():
+                break
+            await asyncio.sleep(0.01)
+        if server.done():
+            server.result()
+        assert os.path.exists(path)
+        loop = asyncio.get_running_loop()
+        values = await loop.run_in_executor(None, request_calibration, df, path)
+        with pytest.raises(RuntimeError):
+            await loop.run_in_executor(None, request_calibration, {'teff_gspphot': [1.]}, path)
+        server.cancel()
+        await service.stop()
+        return values
+
+    values = asyncio.run(run())
+    numpy.testing.assert_allclose(values, expected, atol=1e-10)
@@ -0,0 +1,35 @@
+""" Unit tests for the shared-memory multiprocessing helper """
+import multiprocessing
+import numpy
+import pytest
+from gdr3apcal.calibration import GaiaDR3_GSPPhot_cal
+from gdr3apcal.sharedmem import SharedCalibrationBuffers, calibrate_shared
+from conftest import generate_random_data
+
+# multiprocessing.shared_memory requires Python >= 3.8
+pytest.importorskip("multiprocessing.shared_memory")
+
+
+def test_buffers_attach_without_copy() -> None:
+    """ attached buffers share the same memory """
+    buffers = SharedCalibrationBuffers.create(10, 3)
+    try:
+        other = SharedCalibrationBuffers.attach(buffers.spec)
+        other.output[:] = 2.
+        assert (buffers.output == 2.).all()
+        other.close()
+    finally:
+        buffers.close()
+        buffers.unlink()
+
+
+def test_calibrate_shared() -> None:
+    """ the pool writes the in-memory result into the shared output """
+    df = generate_random_data(100)
+    expected, expected_flags = GaiaDR3_GSPPhot_cal().calibrateMetallicity(df.copy(), return_flags=True)
+    # fork is not available on Windows
+    for mp_context in [m for m in ('fork', 'spawn') if m in multiprocessing.get_all_start_methods()]:
+        values, flags = calibrate_shared(df.copy(), n_workers=2, chunk_size=30,
+                                         return_flags=True, mp_context=mp_context)
+        numpy.testing.assert_allclose(values, expected, rtol=0, atol=1e-12)
+        numpy.testing.assert_array_equal(flags, expected_flags)
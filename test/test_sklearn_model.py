@@ -0,0 +1,34 @@
+""" Unit tests for the chunked SklearnModel prediction """
+import numpy
+import pandas
+from sklearn.linear_model import LinearRegression
+from gdr3apcal.calibration_models import SklearnModel
+
+
+def generate_training_data(n_rows: int = 1000, seed: int = 7) -> pandas.DataFrame:
+    """ Linear toy calibration """
+    rng = numpy.random.default_rng(seed)
+    df = pandas.DataFrame(rng.normal(size=(n_rows, 3)), columns=['a', 'b', 'label'])
+    return df
+
+
+def test_chunked_prediction_in_order() -> None:
+    """ thread and process pools give the sequential result """
+    df = generate_training_data()
+    estimator = LinearRegression().fit(df[['a', 'b']].values, df['label'].values)
+    df.at[3, 'a'] = float('nan')
+
+    expected = SklearnModel('toy', estimator, ['a', 'b'], 'label')(df)
+    assert numpy.isnan(expected[3])
+    for backend in ('thread', 'process'):
+        model = SklearnModel('toy', estimator, ['a', 'b'], 'label',
+                             n_jobs=2, chunk_size=64, backend=backend)
+        numpy.testing.assert_array_equal(model(df), expected)
+        # the pool is kept for the next predictions
+        pool = model._executor
+        numpy.testing.assert_array_equal(model(df), expected)
+        assert model._executor is pool
+        model.shutdown()
+        assert model._executor is None
+        numpy.testing.assert_array_equal(model(df), expected)
+        model.shutdown()